@@ -0,0 +1,141 @@
+"""
+Load test of the read routes: gunicorn with its production settings
+(gunicorn.conf.py, gthread workers, as in the Procfile) against uvicorn
+serving asgi.py, on a throwaway SQLite database, at high concurrency.
+
+    $ pipenv run python benchmarks/asgi_load.py --concurrency 200 --query-ms 20
+
+--query-ms adds that much latency to every query (a remote database); the
+caches are disabled unless --cache is given, so every request queries. Both
+servers get the same number of worker processes, and of threads per worker:
+asgi.py is a thread-pool bridge, each request still blocks a thread on the
+database.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+from dataset import ROOT, load_app, seed
+
+PATHS = ['/characters?limit=20', '/planets?limit=20', '/vehicles?limit=20', '/characters/{n}', '/planets/{n}',
+         '/vehicles/{n}/characters', '/users/{u}/favorites', '/characters?gender=female&limit=20']
+
+# imported by the servers instead of wsgi/asgi, to slow the queries down
+WRAPPER = """
+import os, time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+delay = float(os.environ['BENCH_QUERY_MS']) / 1000
+if delay:
+    event.listen(Engine, 'before_cursor_execute', lambda *args: time.sleep(delay))
+from {module} import {name} as application
+"""
+
+
+async def fetch(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    return int(data.split(b' ', 2)[1])
+
+
+async def load(port, concurrency, duration, rows, users):
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    rng = random.Random(1)
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            path = rng.choice(PATHS).format(n=rng.randint(1, rows), u=rng.randint(1, users))
+            start = time.perf_counter()
+            try:
+                status = await fetch(port, path)
+            except OSError:
+                status = None
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def wait_for(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'server exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000, help='rows per catalog table')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per server')
+    parser.add_argument('--query-ms', type=float, default=20)
+    parser.add_argument('--cache', action='store_true', help='keep the response and entity caches on')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    database_url = f"sqlite:///{os.path.join(folder, 'load.db')}"
+    app, db = load_app(database_url)
+    users = 50
+    with app.app_context():
+        seed(db, characters=args.rows, vehicles=args.rows // 10, planets=args.rows // 10, users=users)
+    for module, name in (('wsgi', 'application'), ('asgi', 'application')):
+        with open(os.path.join(folder, f'bench_{module}.py'), 'w') as f:
+            f.write(textwrap.dedent(WRAPPER.format(module=module, name=name)))
+
+    env = dict(os.environ, DATABASE_URL=database_url, BENCH_QUERY_MS=str(args.query_ms),
+               PYTHONPATH=os.pathsep.join([folder, os.path.join(ROOT, 'src')]))
+    env.pop('REPLICA_DATABASE_URL', None)
+    env.update(WEB_CONCURRENCY=str(args.workers), GUNICORN_WORKLOAD='io')
+    if not args.cache:
+        env.update(RESPONSE_CACHE_SIZE='0', ENTITY_CACHE_SIZE='0')
+    bin_dir = os.path.dirname(sys.executable)
+    servers = {
+        f'gunicorn gthread x{args.workers}': [os.path.join(bin_dir, 'gunicorn'), 'bench_wsgi:application',
+                                              '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+                                              '--bind', '127.0.0.1:{port}', '--log-level', 'warning'],
+        f'uvicorn asgi x{args.workers}': [os.path.join(bin_dir, 'uvicorn'), 'bench_asgi:application',
+                                          '--workers', str(args.workers), '--port', '{port}',
+                                          '--log-level', 'warning', '--no-access-log']
+    }
+
+    print(f"{args.concurrency} concurrent clients, {args.duration:.0f}s each, +{args.query_ms:.0f} ms per query")
+    print(f"{'server':<22}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for port, (label, command) in enumerate(servers.items(), start=8700):
+        process = subprocess.Popen([part.format(port=port) for part in command], env=env, cwd=folder)
+        try:
+            wait_for(port, process)
+            latencies, errors = asyncio.run(load(port, args.concurrency, args.duration, args.rows // 10, users))
+        finally:
+            process.terminate()
+            process.wait()
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        print(f"{label:<22}{len(latencies) / args.duration:>9.0f}"
+              f"{statistics.median(latencies) * 1000 if latencies else 0:>10.1f}{p99:>10.1f}{errors:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Worker boot time: how long importing src/app.py takes and how long until the
+first request is answered, in the default (development) setup and with
+API_ONLY=true. Every sample is a fresh interpreter.
+
+    $ pipenv run python benchmarks/boot.py --repeat 9
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from dataset import ROOT, load_app, seed
+
+# run in the child process
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+response = app.test_client().get('/planets/1')
+answered = time.perf_counter()
+assert response.status_code == 200, response.data
+print(json.dumps({'import': imported - start, 'first_request': answered - start,
+                  'modules': len(sys.modules), 'flask_admin': 'flask_admin' in sys.modules,
+                  'alembic': 'alembic' in sys.modules}))
+"""
+
+
+def sample(env):
+    output = subprocess.run([sys.executable, '-c', PROBE], env=env, cwd=os.path.join(ROOT, 'src'),
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=9)
+    args = parser.parse_args()
+
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'boot.db')}"
+    app, db = load_app(database_url)
+    with app.app_context():
+        seed(db, characters=10, vehicles=10, planets=10, users=1)
+
+    base = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=os.path.join(ROOT, 'src'))
+    for key in ('API_ONLY', 'FLASK_RUN_FROM_CLI', 'REPLICA_DATABASE_URL'):
+        base.pop(key, None)
+    modes = {'default': base, 'API_ONLY=true': dict(base, API_ONLY='true')}
+
+    print(f"{'mode':<16}{'import ms':>11}{'first request ms':>18}{'modules':>9}  loaded")
+    for label, env in modes.items():
+        samples = [sample(env) for _ in range(args.repeat)]
+        loaded = [name for name in ('flask_admin', 'alembic') if samples[-1][name]]
+        print(f"{label:<16}{statistics.median(s['import'] for s in samples) * 1000:>11.0f}"
+              f"{statistics.median(s['first_request'] for s in samples) * 1000:>18.0f}"
+              f"{samples[-1]['modules']:>9}  {', '.join(loaded) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Delta sync with /changes (changes.py) against refetching everything, on
+throwaway SQLite databases of growing size with the same churn applied to
+each, through the Flask test client.
+
+    $ pipenv run python benchmarks/changes.py --scales 1000,10000,50000 --churn 200
+
+A client copies the catalog and every user's favorites after taking a
+/changes cursor, then the churn runs (bulk upserts, renames, vehicle links,
+favorite batches, inserts and deletes). The client catches up by paging
+/changes; its copy must then equal a fresh full fetch. The catch-up should
+cost about the same at every scale, the full fetch grows with the data.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from dataset import load_app, seed
+
+COLLECTIONS = {'character': '/characters', 'planet': '/planets', 'vehicle': '/vehicles'}
+
+
+def full_fetch(client):
+    # type -> {id: data}, and the bytes it took
+    copy, size = {}, 0
+    for kind, path in COLLECTIONS.items():
+        response = client.get(f'{path}?stream=true')
+        size += len(response.data)
+        copy[kind] = {row['id']: row for row in response.get_json()}
+    response = client.get('/users?stream=true')
+    size += len(response.data)
+    copy['favorite'] = {f['id']: f for user in response.get_json() for f in user['favorites']}
+    return copy, size
+
+
+def catch_up(client, copy, cursor, limit):
+    requests = size = queries = 0
+    while True:
+        response = client.get(f'/changes?since={cursor}&limit={limit}')
+        requests += 1
+        size += len(response.data)
+        queries += int(response.headers['X-Query-Count'])
+        body = response.get_json()
+        for change in body['changes']:
+            if change['op'] == 'delete':
+                copy[change['type']].pop(change['id'], None)
+            else:
+                copy[change['type']][change['id']] = change['data']
+        cursor = body['cursor']
+        if not body['has_more']:
+            return cursor, requests, size, queries
+
+
+def churn(app, db, client, count, rng):
+    from models import Character, Vehicle, Planet, Character_X_Vehicle
+    with app.app_context():
+        characters = Character.query.count()
+        users = db.session.execute('SELECT count(*) FROM user').scalar()
+    # bulk upserts of existing characters, a new hair color each
+    ids = rng.sample(range(1, characters + 1), count // 4)
+    with app.app_context():
+        rows = [{c.name: getattr(character, c.name) for c in Character.__table__.columns if c.name != 'id'}
+                for character in Character.query.filter(Character.id.in_(ids))]
+        db.session.remove()
+    for row in rows:
+        row['hair_color'] = rng.choice(['auburn', 'grey', 'white', 'blue'])
+    assert client.post('/characters/create', json=rows).get_json()['updated'] == len(rows)
+    # favorite batches, adds and removes
+    for _ in range(count // 4 // 10):
+        items = [{'type': rng.choice(['characters', 'planets', 'vehicles']), 'id': rng.randint(1, 50)}
+                 for _ in range(10)]
+        client.post(f'/users/{rng.randint(1, users)}/favorites/batch', json={'add': items[:6], 'remove': items[6:]})
+    with app.app_context():
+        # renames, which reach the favorites and vehicles embedding the names
+        for character in Character.query.filter(Character.id.in_(rng.sample(range(1, characters + 1), count // 20))):
+            character.name = f'{character.name} (renamed)'
+        for vehicle in Vehicle.query.filter(Vehicle.id.in_(rng.sample(range(1, 51), count // 40))):
+            vehicle.name = f'{vehicle.name} (renamed)'
+        # vehicle links
+        links = Character_X_Vehicle.query.filter(Character_X_Vehicle.character_id.in_(
+            rng.sample(range(1, characters + 1), count // 20)))
+        for link in links:
+            db.session.delete(link)
+        # new planets, and one deleted right away
+        planets = [Planet(name=f'new planet {rng.random()}') for _ in range(count // 10)]
+        db.session.add_all(planets)
+        db.session.flush()
+        db.session.delete(planets[0])
+        db.session.commit()
+        db.session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000,50000', help='characters per run')
+    parser.add_argument('--churn', type=int, default=200, help='writes per run')
+    parser.add_argument('--limit', type=int, default=200, help='/changes page size')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'changes.db')}", MAX_PAGE_SIZE=args.limit,
+                       RESPONSE_CACHE_SIZE=0, ENTITY_CACHE_SIZE=0, QUERY_DEBUG='log', QUERY_REPEATS=1000000)
+    from utils import decode_cursor
+    client = app.test_client()
+    rng = random.Random(7)
+    failed = False
+    print(f"{'characters':>10}{'full fetch':>12}{'full KB':>10}{'changes':>10}{'catch-up':>10}"
+          f"{'pages':>7}{'queries':>9}{'KB':>8}  copy")
+    for scale in (int(s) for s in args.scales.split(',')):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            seed(db, characters=scale, vehicles=max(50, scale // 10), planets=max(50, scale // 100),
+                 users=20, favorites_per_user=20)
+            db.session.remove()
+        cursor = client.get('/changes').get_json()['cursor']
+        start = time.perf_counter()
+        copy, full_size = full_fetch(client)
+        full_time = time.perf_counter() - start
+
+        churn(app, db, client, args.churn, rng)
+        with app.app_context():
+            logged = db.session.execute('SELECT count(*) FROM change_log WHERE id > :id',
+                                        {'id': decode_cursor(cursor)[1]}).scalar()
+            db.session.remove()
+
+        start = time.perf_counter()
+        cursor, pages, size, queries = catch_up(client, copy, cursor, args.limit)
+        elapsed = time.perf_counter() - start
+        fresh, _ = full_fetch(client)
+        same = copy == fresh
+        failed |= not same
+        # a poll with nothing new
+        empty = client.get(f'/changes?since={cursor}').get_json()
+        failed |= bool(empty['changes']) or empty['cursor'] != cursor
+        print(f"{scale:>10}{full_time * 1000:>10.0f}ms{full_size / 1024:>10.0f}{logged:>10}{elapsed * 1000:>8.0f}ms"
+              f"{pages:>7}{queries:>9}{size / 1024:>8.0f}  {'ok' if same else 'DIFFERS'}")
+        if not same:
+            for kind in fresh:
+                wrong = [i for i in set(fresh[kind]) | set(copy[kind]) if fresh[kind].get(i) != copy[kind].get(i)]
+                if wrong:
+                    print(f'  {kind}: {len(wrong)} rows differ, e.g. {sorted(wrong)[:5]}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Synthetic SWAPI-like datasets for the scripts in this folder.
+
+    from dataset import load_app, seed
+    app, db = load_app('sqlite:////tmp/bench.db')
+    with app.app_context():
+        seed(db, characters=1000, vehicles=100, planets=60)
+"""
+import itertools
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(database_url, **config):
+    # the app reads its configuration from the environment at import time
+    os.environ['DATABASE_URL'] = database_url
+    for key, value in config.items():
+        os.environ[key] = str(value)
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    from app import app
+    from models import db
+    with app.app_context():
+        db.create_all()
+    return app, db
+
+
+def _insert(db, model, rows, chunk_size=5000):
+    # rows can be a generator, large tables are never held in memory whole
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        db.session.bulk_insert_mappings(model, chunk)
+        db.session.commit()
+
+
+def _favorites(rng, users, favorites_per_user, targets):
+    for user_id in range(1, users + 1):
+        chosen = set()
+        for _ in range(favorites_per_user):
+            column, count = rng.choice(targets)
+            if count:
+                chosen.add((column, rng.randint(1, count)))
+        # sorted: set order follows the (per process) string hashing
+        yield from ({"user_id": user_id, column: target_id} for column, target_id in sorted(chosen))
+
+
+def seed(db, characters=1000, vehicles=100, planets=60, users=10, favorites_per_user=20,
+         vehicles_per_character=2, random_seed=42):
+    from models import Planet, Vehicle, Character, Character_X_Vehicle, User, Favorite
+    rng = random.Random(random_seed)
+    _insert(db, Planet, (
+        {"name": f"planet {i}", "url": f"https://swapi.dev/api/planets/{i}/", "diameter_in_km": 10465.0 + i,
+         "rotation_period_in_days": 23.0, "orbital_period_in_days": 304.0, "gravity_in_g": 1.0,
+         "population": 200000 + i, "climate": rng.choice(["arid", "temperate", "frozen", "murky"]),
+         "terrain": rng.choice(["desert", "grasslands, mountains", "jungle", "tundra"]),
+         "surface_water_percent": float(i % 100)}
+        for i in range(1, planets + 1)))
+    _insert(db, Vehicle, (
+        {"name": f"vehicle {i}", "url": f"https://swapi.dev/api/vehicles/{i}/", "model": f"model {i % 50}",
+         "vehicle_class": rng.choice(["speeder", "wheeled", "repulsorcraft", "airspeeder"]),
+         "manufacturer": rng.choice(["Aratech Repulsor Company", "Incom Corporation", "Corellia Mining Corporation"]),
+         "cost_in_credits": float(rng.randint(1000, 200000)), "length_in_m": round(rng.uniform(2, 40), 2),
+         "crew": rng.randint(1, 10), "passengers": rng.randint(0, 30),
+         "max_atmosphering_speed_in_kmh": float(rng.randint(100, 1500)), "cargo_capacity_in_kg": float(rng.randint(0, 100000))}
+        for i in range(1, vehicles + 1)))
+    _insert(db, Character, (
+        {"name": f"character {i}", "url": f"https://swapi.dev/api/people/{i}/", "height_in_cm": float(rng.randint(60, 230)),
+         "mass_in_kg": float(rng.randint(20, 150)), "hair_color": rng.choice(["blond", "brown", "black", "none"]),
+         "skin_color": rng.choice(["fair", "light", "gold", "green"]), "eye_color": rng.choice(["blue", "brown", "red"]),
+         "birthyear": f"{rng.randint(1, 900)}BBY", "gender": rng.choice(["male", "female", "n/a"]),
+         "planet_id": rng.randint(1, planets) if planets else None}
+        for i in range(1, characters + 1)))
+    if vehicles:
+        _insert(db, Character_X_Vehicle, (
+            {"character_id": i, "vehicle_id": vehicle_id}
+            for i in range(1, characters + 1)
+            for vehicle_id in rng.sample(range(1, vehicles + 1), min(vehicles_per_character, vehicles))))
+    _insert(db, User, ({"username": f"user{i}", "password": "secret"} for i in range(1, users + 1)))
+    targets = [('character_id', characters), ('planet_id', planets), ('vehicle_id', vehicles)]
+    _insert(db, Favorite, _favorites(rng, users, favorites_per_user, targets))
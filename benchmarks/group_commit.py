@@ -0,0 +1,107 @@
+"""
+Favorite writes under contention, each request committing its own
+transaction against FAVORITES_GROUP_COMMIT (group_commit.py), on a
+throwaway SQLite database through the Flask test client.
+
+    $ pipenv run python benchmarks/group_commit.py --threads 32 --commit-ms 5
+
+Every thread adds and then deletes favorites for its own user. --commit-ms
+makes every COMMIT that much slower (a remote database, an fsync), which is
+the cost group commit spreads over the batch. At the end the favorites table
+must be back to its seeded size.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from dataset import load_app, seed
+
+
+def run(app, threads, writes):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def client(user_id):
+        client = app.test_client()
+        barrier.wait()
+        created = []
+        for i in range(1, writes + 1):
+            start = time.perf_counter()
+            response = client.post(f'/users/{user_id}/favorites/characters/{i}/add')
+            elapsed = time.perf_counter() - start
+            body = response.get_json()
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200 or 'error' in body:
+                    errors.append(body)
+                else:
+                    created.append(body['id'])
+        for fav_id in created:
+            start = time.perf_counter()
+            response = client.delete(f'/users/{user_id}/favorites/{fav_id}/delete')
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200 or 'error' in response.get_json():
+                    errors.append(response.get_json())
+
+    workers = [threading.Thread(target=client, args=(user_id,)) for user_id in range(1, threads + 1)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--writes', type=int, default=20, help='adds (and as many deletes) per thread')
+    parser.add_argument('--commit-ms', type=float, default=5)
+    parser.add_argument('--window-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'group_commit.db')}",
+                       FAVORITES_COMMIT_WINDOW_MS=args.window_ms)
+    import favorites
+    from group_commit import GroupCommitWriter
+    from models import Favorite
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    with app.app_context():
+        seed(db, characters=args.writes, vehicles=0, planets=0, users=args.threads, favorites_per_user=0)
+    if args.commit_ms:
+        event.listen(Engine, 'commit', lambda conn: time.sleep(args.commit_ms / 1000))
+
+    group_writer = GroupCommitWriter(app, favorites.write_many, 'favorite', window=args.window_ms / 1000,
+                                     max_batch=app.config['FAVORITES_COMMIT_MAX_BATCH'])
+    print(f"{args.threads} threads x {args.writes * 2} writes, +{args.commit_ms:g} ms per commit")
+    print(f"{'mode':<16}{'writes/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'batch':>8}")
+    failed = False
+    for label, writer in (('commit each', None), ('group commit', group_writer)):
+        favorites.writer = writer
+        latencies, errors, elapsed = run(app, args.threads, args.writes)
+        latencies.sort()
+        batch = (f'{writer.batch_sizes.sum / writer.batch_sizes.count:.1f}'
+                 if writer is not None and writer.batch_sizes.count else '1')
+        print(f"{label:<16}{len(latencies) / elapsed:>10.0f}{statistics.median(latencies) * 1000:>10.1f}"
+              f"{latencies[int(len(latencies) * 0.99)] * 1000:>10.1f}{len(errors):>8}{batch:>8}")
+        with app.app_context():
+            left = Favorite.query.count()
+            db.session.remove()
+        if left:
+            print(f'{left} favorites left behind')
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Bulk upsert through the create routes (ingest.py) on a throwaway SQLite
+database, through the Flask test client.
+
+    $ pipenv run python benchmarks/ingest.py --rows 20000
+
+Loads --rows planets as a JSON array and again as NDJSON (every row an
+update the second time), then checks the matching on url or name: rows
+without a url must match on their name only, and never a record whose url
+or name is NULL.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from dataset import load_app
+
+
+def post(client, rows, ndjson=False):
+    if ndjson:
+        body = '\n'.join(json.dumps(row) for row in rows)
+        return client.post('/planets/create', data=body, content_type='application/x-ndjson').get_json()
+    return client.post('/planets/create', json=rows).get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'ingest.db')}")
+    client = app.test_client()
+    failures = []
+
+    rows = [{'name': f'planet {i}', 'url': f'https://swapi.dev/api/planets/{i}/', 'climate': 'arid',
+             'population': str(1000 + i)} for i in range(args.rows)]
+    for label, ndjson, expected in (('json, inserts', False, 'inserted'), ('ndjson, updates', True, 'updated')):
+        start = time.perf_counter()
+        result = post(client, rows, ndjson)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<18}{args.rows:>8} rows {elapsed:>7.2f}s  {result['inserted']} inserted, "
+              f"{result['updated']} updated, {len(result['errors'])} errors")
+        if result[expected] != args.rows or result['errors']:
+            failures.append(label)
+
+    # name-only rows, next to records without a url
+    cases = [
+        ('a new name inserts', [{'name': 'Alpha', 'climate': 'arid'}, {'name': 'Delta'}], (1, 1)),
+        ('the same names update', [{'name': 'Alpha'}, {'name': 'Delta', 'climate': 'frozen'}], (0, 2)),
+        ('another new name inserts', [{'name': 'Alpha'}, {'name': 'Beta'}], (1, 1)),
+        ('a new url inserts', [{'url': 'https://example.com/planets/1/'}], (1, 0)),
+        ('a name-only row skips url-only records', [{'name': 'Gamma'}], (1, 0)),
+    ]
+    post(client, [{'name': 'Alpha', 'climate': 'temperate'}])
+    for label, batch, (inserted, updated) in cases:
+        result = post(client, batch)
+        ok = (result['inserted'], result['updated']) == (inserted, updated) and not result['errors']
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {result}")
+        if not ok:
+            failures.append(label)
+    with app.app_context():
+        names = [name for name, in db.session.execute(
+            "SELECT name FROM planet WHERE url IS NULL OR name IS NULL ORDER BY id")]
+    if names != ['Alpha', 'Delta', 'Beta', None, 'Gamma']:
+        print(f'FAIL records without a url or name: {names}')
+        failures.append('records')
+
+    if failures:
+        print(f"\nfailed: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+"""
+Load test of every route, against the production setup (gunicorn with
+gunicorn.conf.py, API_ONLY=true) on a seeded SQLite or Postgres database.
+Each route gets the same number of requests at a fixed concurrency, and the
+results go to a JSON file meant to be diffed between commits, by default in
+benchmarks/results/ (ignored by git):
+
+    $ pipenv run python benchmarks/load_test.py --scale medium --output benchmarks/results/before.json
+    $ git checkout my-branch
+    $ pipenv run python benchmarks/load_test.py --scale medium --output benchmarks/results/after.json
+    $ pipenv run python benchmarks/load_test.py --compare benchmarks/results/before.json benchmarks/results/after.json
+
+Per route it reports requests/s, p50/p95/p99 latency, errors, queries per
+request (the X-Query-Count header, so the servers run with QUERY_DEBUG=log;
+streamed bodies are not counted) and the peak RSS of the workers so far
+(Linux only).
+
+The dataset is seeded once (dataset.py, deterministic) and reused while its
+row counts match the scale; --scale large is 100k characters with 10 vehicles
+each, 10k vehicles and ~1M favorites. Postgres:
+
+    $ pipenv run python benchmarks/load_test.py --database-url postgresql://localhost/swbench
+
+The write routes only run with --writes. They leave the dataset as they found
+it: the favorites added are deleted again (one by one and in batches) and
+the bulk creates re-send existing rows, which are updated in place.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from dataset import ROOT, load_app, seed
+
+# where the result files go by default, ignored by git
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+
+SCALES = {
+    'small': dict(characters=2000, vehicles=200, planets=60, users=100, favorites_per_user=20,
+                  vehicles_per_character=3),
+    'medium': dict(characters=20000, vehicles=2000, planets=200, users=2000, favorites_per_user=50,
+                   vehicles_per_character=5),
+    'large': dict(characters=100000, vehicles=10000, planets=1000, users=10000, favorites_per_user=100,
+                  vehicles_per_character=10),
+}
+
+TARGET_GROUPS = ('characters', 'planets', 'vehicles')
+SEARCH_TERMS = ['desert', 'speeder', 'female', 'planet 7', 'character 12', 'incom', 'arid tundra', 'blue']
+
+# name, method, path; {character}, {planet}... are random ids within the scale
+READS = [
+    ('users', 'GET', '/users?limit=20'),
+    ('users_expanded', 'GET', '/users?limit=20&expand=favorites'),
+    ('user', 'GET', '/users/{user}'),
+    ('user_favorites', 'GET', '/users/{user}/favorites'),
+    ('user_favorites_expanded', 'GET', '/users/{user}/favorites?expand=favorites'),
+    ('characters', 'GET', '/characters?limit=50'),
+    ('characters_filtered', 'GET', '/characters?gender=female&sort=-height_in_cm&limit=50'),
+    ('characters_fields', 'GET', '/characters?fields=id,name&limit=200'),
+    ('character', 'GET', '/characters/{character}'),
+    ('character_vehicles', 'GET', '/characters/{character}/vehicles'),
+    ('planets', 'GET', '/planets?limit=50'),
+    ('planets_filtered', 'GET', '/planets?climate=arid&sort=name'),
+    ('planets_stream', 'GET', '/planets?stream=true'),
+    ('planet', 'GET', '/planets/{planet}'),
+    ('vehicles', 'GET', '/vehicles?limit=50'),
+    ('vehicles_filtered', 'GET', '/vehicles?vehicle_class=speeder&sort=-cost_in_credits'),
+    ('vehicle', 'GET', '/vehicles/{vehicle}'),
+    ('vehicle_characters', 'GET', '/vehicles/{vehicle}/characters'),
+    ('search', 'GET', '/search?q={term}'),
+    ('changes', 'GET', '/changes?since=WzAsMF0&limit=50'),  # the first page of the log
+    ('snapshot_manifest', 'GET', '/snapshots'),
+    ('snapshot', 'GET', '/snapshots/characters.ndjson'),
+]
+WRITES = [
+    ('add_favorite', 'POST', '/users/{user}/favorites/{group}/{target}/add'),
+    ('delete_favorite', 'DELETE', '/users/{owner}/favorites/{favorite}/delete'),
+    ('batch_favorites_add', 'POST', '/users/{user}/favorites/batch'),
+    ('batch_favorites_remove', 'POST', '/users/{user}/favorites/batch'),
+    ('create_characters', 'POST', '/characters/create'),
+    ('create_planets', 'POST', '/planets/create'),
+    ('create_vehicles', 'POST', '/vehicles/create'),
+]
+# endpoints that are not load tested
+SKIPPED = {'static', 'sitemap', 'get_metrics', 'get_cache_stats', 'get_pool_stats',
+           # the same files as get_snapshot, under their version
+           'get_snapshot_version'}
+
+
+def prepare(database_url, scale, reseed):
+    # the snapshots next to their database; the server inherits the environment
+    app, db = load_app(database_url, API_ONLY='true',
+                       SNAPSHOT_DIR=os.path.join(tempfile.gettempdir(), f"sw_load_{scale['characters']}_snapshots"))
+    from models import Character, Vehicle, User
+    from snapshots import snapshots
+    with app.app_context():
+        counts = (Character.query.count(), Vehicle.query.count(), User.query.count())
+        if reseed or counts != (scale['characters'], scale['vehicles'], scale['users']):
+            print(f"seeding {database_url} ...", flush=True)
+            start = time.perf_counter()
+            db.drop_all()
+            db.create_all()
+            seed(db, **scale)
+            print(f"seeded in {time.perf_counter() - start:.0f}s", flush=True)
+        # the server would build them in the background, during the test
+        snapshots.build()
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return app, db
+
+
+def uncovered(app, routes):
+    urls = app.url_map.bind('localhost')
+    covered = {urls.match(path.split('?')[0].format(user=1, owner=1, character=1, planet=1, vehicle=1,
+                                                    group='planets', target=1, favorite=1, term=''),
+                          method=method)[0]
+               for _, method, path in routes}
+    return sorted({rule.endpoint for rule in app.url_map.iter_rules()} - covered - SKIPPED)
+
+
+def upsert_bodies(app, db, rows=20):
+    # existing rows, as the bulk create routes take them
+    from models import Character, Planet, Vehicle
+    bodies = {}
+    with app.app_context():
+        for name, model in (('create_characters', Character), ('create_planets', Planet),
+                            ('create_vehicles', Vehicle)):
+            columns = [c for c in model.__table__.columns if c.name != 'id']
+            bodies[name] = json.dumps([{c.name: getattr(obj, c.name) for c in columns}
+                                       for obj in model.query.order_by(model.id).limit(rows)]).encode()
+        db.session.remove()
+    return bodies
+
+
+def newest_favorites(app, db, after_id, limit):
+    # the favorites add_favorite just created
+    from models import Favorite
+    with app.app_context():
+        rows = (db.session.query(Favorite.id, Favorite.user_id).filter(Favorite.id > after_id)
+                .order_by(Favorite.id).limit(limit).all())
+        db.session.remove()
+    return [tuple(row) for row in rows]
+
+
+def last_favorite_id(app, db):
+    from models import Favorite
+    with app.app_context():
+        last = db.session.query(db.func.max(Favorite.id)).scalar() or 0
+        db.session.remove()
+    return last
+
+
+class Target:
+    # request number -> (method, path, body) of one route, the same on every
+    # run. written holds what the write routes added, for the ones removing
+    # it again: the ids add_favorite created, the items each batch added.
+
+    def __init__(self, name, method, path, scale, bodies, written):
+        self.name, self.method, self.path = name, method, path
+        self.scale = scale
+        self.body = bodies.get(name)
+        self.written = written
+
+    def request(self, i):
+        rng = random.Random(f'{self.name}:{i}')
+        scale = self.scale
+        values = dict(user=rng.randint(1, scale['users']), character=rng.randint(1, scale['characters']),
+                      planet=rng.randint(1, scale['planets']), vehicle=rng.randint(1, scale['vehicles']),
+                      term=rng.choice(SEARCH_TERMS).replace(' ', '+'))
+        values['group'] = group = rng.choice(['characters', 'planets', 'vehicles'])
+        values['target'] = values[group[:-1]]
+        body = self.body
+        if self.name == 'delete_favorite':
+            if i >= len(self.written['favorites']):
+                return None
+            values['favorite'], values['owner'] = self.written['favorites'][i]
+        elif self.name == 'batch_favorites_add':
+            groups = [rng.choice(list(TARGET_GROUPS)) for _ in range(10)]
+            body = json.dumps({'add': [{'type': group, 'id': rng.randint(1, scale[group])} for group in groups]}).encode()
+        elif self.name == 'batch_favorites_remove':
+            if i >= len(self.written['batches']):
+                return None
+            values['user'], items = self.written['batches'][i]
+            body = json.dumps({'remove': items}).encode()
+        return self.method, self.path.format(**values), body
+
+    def answered(self, i, path, data):
+        if self.name == 'batch_favorites_add' and data.startswith(b'['):
+            user = int(path.split('/')[2])
+            added = [{'type': r['type'], 'id': r['id']} for r in json.loads(data) if r['status'] == 'added']
+            self.written['batches'].append((user, added))
+
+
+def drive(port, target, requests, concurrency):
+    counter = itertools.count()
+    latencies, queries = [], []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            i = next(counter)
+            if i >= requests:
+                break
+            request = target.request(i)
+            if request is None:
+                break
+            method, path, body = request
+            headers = {'Content-Type': 'application/json'} if body else {}
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            target.answered(i, path, data)
+            # the routes answer failures with {"error": ...} and a 200
+            failed = response.status >= 400 or data[:20].lstrip().startswith(b'{"error"')
+            with lock:
+                if failed:
+                    errors[0] += 1
+                latencies.append(elapsed)
+                count = response.getheader('X-Query-Count')
+                if count is not None:
+                    queries.append(int(count))
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, queries, errors[0], time.perf_counter() - start
+
+
+def worker_peak_rss(master):
+    # highest VmHWM (peak resident set) of the gunicorn workers, in MB
+    if not os.path.isdir('/proc'):
+        return None
+    peak = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) != master:
+                    continue
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak, int(line.split()[1]) / 1024)
+        except (OSError, IndexError, ValueError):
+            continue
+    return round(peak, 1)
+
+
+def summary(latencies, queries, errors, elapsed):
+    result = {'requests': len(latencies), 'errors': errors,
+              'requests_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0}
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+        result.update(p50_ms=round(cuts[49] * 1000, 2), p95_ms=round(cuts[94] * 1000, 2),
+                      p99_ms=round(cuts[98] * 1000, 2), mean_ms=round(statistics.fmean(latencies) * 1000, 2))
+    if queries:
+        result['queries_per_request'] = round(statistics.fmean(queries), 2)
+    return result
+
+
+def start_server(database_url, port, args, log):
+    env = dict(os.environ, DATABASE_URL=database_url, PORT=str(port), API_ONLY='true',
+               QUERY_DEBUG='log', QUERY_REPEATS='1000000', GUNICORN_MAX_REQUESTS='0',
+               GUNICORN_LOGLEVEL='warning')
+    env.pop('REPLICA_DATABASE_URL', None)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    if args.no_cache:
+        env.update(RESPONSE_CACHE_SIZE='0', ENTITY_CACHE_SIZE='0')
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    process = subprocess.Popen([gunicorn, 'wsgi', '--config', os.path.join(ROOT, 'gunicorn.conf.py')],
+                               env=env, cwd=ROOT, stdout=log, stderr=log)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited with {process.returncode}, see {log.name}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'gunicorn did not start, see {log.name}')
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    print(f"{'route':<26}{'req/s':>22}{'p95 ms':>22}{'queries':>22}")
+    for name, new in after['routes'].items():
+        old = before['routes'].get(name)
+        if old is None:
+            print(f"{name:<26} (new)")
+            continue
+
+        def delta(key):
+            a, b = old.get(key), new.get(key)
+            if a is None or b is None:
+                return f"{'-':>6}"
+            change = f'{(b - a) / a * 100:+.0f}%' if a else ''
+            return f'{a:>7g} {b:>7g} {change:>5}'
+        print(f"{name:<26}{delta('requests_per_s'):>22}{delta('p95_ms'):>22}{delta('queries_per_request'):>22}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    for key in SCALES['small']:
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, help='overrides the scale')
+    parser.add_argument('--database-url', help='default: a SQLite file in the temp folder, kept between runs')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--requests', type=int, default=1000, help='per route')
+    parser.add_argument('--warmup', type=int, default=50, help='requests per route before measuring')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, help='default: gunicorn.conf.py')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response and entity caches')
+    parser.add_argument('--writes', action='store_true', help='also the write routes')
+    parser.add_argument('--routes', help='comma separated route names, default all')
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--output', default=os.path.join(RESULTS, 'load_test.json'))
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='diff two result files')
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), f"sw_load_{scale['characters']}.db")
+    app, db = prepare(database_url, scale, args.reseed)
+
+    routes = READS + (WRITES if args.writes else [])
+    missing = uncovered(app, READS + WRITES)
+    if missing:
+        print(f"warning, routes not in the load test: {', '.join(missing)}")
+    if args.routes:
+        names = args.routes.split(',')
+        routes = [route for route in routes if route[0] in names]
+    bodies = upsert_bodies(app, db) if args.writes else {}
+    seeded_favorites = last_favorite_id(app, db)
+    written = {'favorites': [], 'batches': []}
+
+    log = tempfile.NamedTemporaryFile('w', prefix='load_test_', suffix='.log', delete=False)
+    process = start_server(database_url, args.port, args, log)
+    results = {}
+    try:
+        print(f"{'route':<26}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+              f"{'errors':>8}{'rss MB':>8}", flush=True)
+        for name, method, path in routes:
+            if name == 'delete_favorite':
+                written['favorites'] = newest_favorites(app, db, seeded_favorites, args.requests)
+            target = Target(name, method, path, scale, bodies, written)
+            if args.warmup and method == 'GET':
+                drive(args.port, Target(name + ':warmup', method, path, scale, bodies, written),
+                      args.warmup, args.concurrency)
+            result = summary(*drive(args.port, target, args.requests, args.concurrency))
+            result['peak_rss_mb'] = worker_peak_rss(process.pid)
+            results[name] = result
+            print(f"{name:<26}{result['requests_per_s']:>9}{result.get('p50_ms', '-'):>9}"
+                  f"{result.get('p95_ms', '-'):>9}{result.get('p99_ms', '-'):>9}"
+                  f"{result.get('queries_per_request', '-'):>9}{result['errors']:>8}"
+                  f"{result['peak_rss_mb'] or '-':>8}", flush=True)
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+
+    # once the server has exited: the largest of its processes
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    output = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'database': database_url.split(':', 1)[0],
+            'scale': scale,
+            'requests_per_route': args.requests,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'cache': not args.no_cache,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'peak_rss_mb': round(peak, 1),
+        'routes': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+        f.write('\n')
+    print(f"peak RSS {output['peak_rss_mb']} MB, results in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Measures what the /metrics instrumentation (metrics.py) adds to a request.
+
+    $ pipenv run python benchmarks/metrics_overhead.py [requests per round]
+
+First the hooks alone, as run by a request executing QUERIES statements;
+the script exits non-zero when that goes over BUDGET_US microseconds. Then,
+for context, a few routes through the Flask test client on a seeded SQLite
+database (caches off, so the queries run), with the hooks installed and
+removed in alternating rounds; differences of a few percent there are
+mostly noise.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from dataset import load_app, seed
+
+BUDGET_US = 25
+QUERIES = 10
+ROUNDS = 7
+ROUTES = [
+    '/planets/1',
+    '/characters?limit=50',
+    '/characters?limit=50&gender=female&sort=-height_in_cm',
+    '/users/1/favorites',
+]
+
+
+def set_hooks(app, enabled):
+    import metrics
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    installed = metrics._start_request in app.before_request_funcs.get(None, [])
+    if enabled == installed:
+        return
+    if enabled:
+        app.before_request_funcs.setdefault(None, []).insert(0, metrics._start_request)
+        app.after_request_funcs.setdefault(None, []).append(metrics._end_request)
+        event.listen(Engine, 'before_cursor_execute', metrics._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', metrics._after_cursor_execute)
+    else:
+        app.before_request_funcs[None].remove(metrics._start_request)
+        app.after_request_funcs[None].remove(metrics._end_request)
+        event.remove(Engine, 'before_cursor_execute', metrics._before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', metrics._after_cursor_execute)
+
+
+def hook_cost(app, n):
+    # one request: before/after_request plus QUERIES cursor executions
+    import metrics
+    from flask import Response
+    response = Response('x' * 1000)
+    with app.test_request_context('/planets/1'):
+        start = time.perf_counter()
+        for _ in range(n):
+            metrics._start_request()
+            for _ in range(QUERIES):
+                metrics._before_cursor_execute(None, None, None, None, response, False)
+                metrics._after_cursor_execute(None, None, None, None, response, False)
+            metrics._end_request(response)
+        return (time.perf_counter() - start) / n
+
+
+def timed(client, path, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'metrics.db')}", METRICS='true',
+                       RESPONSE_CACHE_SIZE=0, ENTITY_CACHE_SIZE=0)
+    with app.app_context():
+        seed(db, characters=2000, vehicles=100, planets=60)
+    client = app.test_client()
+
+    cost = min(hook_cost(app, n * 10) for _ in range(ROUNDS))
+    print(f"hooks for a request with {QUERIES} queries: {cost * 1e6:.1f}us (budget {BUDGET_US}us)\n")
+
+    print(f"{'route':<58}{'off':>10}{'on':>10}{'overhead':>12}")
+    for path in ROUTES:
+        best = {False: float('inf'), True: float('inf')}
+        timed(client, path, n // 10 or 1)
+        for i in range(ROUNDS):
+            for enabled in ((False, True) if i % 2 else (True, False)):
+                set_hooks(app, enabled)
+                best[enabled] = min(best[enabled], timed(client, path, n))
+        overhead = best[True] - best[False]
+        print(f"{path:<58}{best[False] * 1e6:>8.0f}us{best[True] * 1e6:>8.0f}us"
+              f"{overhead * 1e6:>7.1f}us {100 * overhead / best[False]:>4.1f}%")
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_bucket{endpoint="get_planet"' in body
+    assert 'http_request_db_queries_total{endpoint="get_characters"' in body
+    print(f"/metrics: {len(body.splitlines())} lines")
+
+    if cost * 1e6 > BUDGET_US:
+        print(f"over budget: {cost * 1e6:.1f}us > {BUDGET_US}us per request")
+        sys.exit(1)
+    print("within budget")
+
+
+if __name__ == '__main__':
+    main()
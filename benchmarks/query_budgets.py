@@ -0,0 +1,125 @@
+"""
+Runs the GET routes (and the favorite writes) with QUERY_DEBUG=raise on a
+seeded SQLite database, caches off, and prints each one's query count next
+to its budget (query_budget.py). Exits non-zero when a route goes over, or
+when an eager-loaded list route runs more queries for a bigger page.
+
+    $ pipenv run python benchmarks/query_budgets.py
+
+It then checks the detector itself on a route written the N+1 way.
+"""
+import logging
+import os
+import sys
+import tempfile
+
+from dataset import load_app, seed
+
+PATHS = [
+    '/users', '/users?expand=favorites', '/users/1', '/users/1?expand=favorites',
+    '/characters', '/characters?limit=200', '/characters?fields=name,vehicles',
+    '/characters?gender=female&sort=-height_in_cm', '/characters/1', '/characters/1/vehicles',
+    '/planets', '/planets?climate=arid&sort=name', '/planets/1',
+    '/vehicles', '/vehicles?vehicle_class=speeder', '/vehicles/1', '/vehicles/1/characters',
+    '/users/1/favorites', '/users/1/favorites?expand=favorites',
+    '/search?q=planet', '/search?q=character+1&type=character',
+    '/changes', '/changes?since=WzAsMF0', '/changes?since=WzAsMF0&type=favorite&user_id=1',
+]
+
+# the list routes whose relationships are eager-loaded: the same queries
+# whatever the page size
+EAGER = ['/characters', '/characters?fields=name,vehicles', '/vehicles', '/users?expand=favorites',
+         '/users/1/favorites?expand=favorites']
+
+
+class Captured(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'budgets.db')}", QUERY_DEBUG='raise',
+                       RESPONSE_CACHE_SIZE=0, ENTITY_CACHE_SIZE=0)
+    app.testing = True
+    from models import Character
+    from query_budget import query_budget, QueryBudgetExceeded
+    with app.app_context():
+        seed(db, characters=500, vehicles=50, planets=30)
+
+    # the N+1 way: one lazy load of Character.vehicles per character
+    @app.route('/naive/characters')
+    @query_budget(2)
+    def naive_characters():
+        return {'vehicles': [len(c.vehicles) for c in Character.query.limit(20)]}
+
+    captured = Captured()
+    logging.getLogger('query_budget').addHandler(captured)
+    client = app.test_client()
+    urls = app.url_map.bind('localhost')
+    failures = []
+
+    print(f"{'route':<52}{'queries':>8}{'budget':>8}")
+    for path in PATHS:
+        try:
+            response = client.get(path)
+        except QueryBudgetExceeded as error:
+            print(f"{path:<52} FAIL {error}")
+            failures.append(path)
+            continue
+        endpoint, _ = urls.match(path.split('?')[0])
+        budget = getattr(app.view_functions[endpoint], 'query_budget', None)
+        print(f"{path:<52}{response.headers['X-Query-Count']:>8}{budget!s:>8}")
+        if response.status_code != 200:
+            failures.append(f'{path} ({response.status_code})')
+
+    for path in EAGER:
+        counts = []
+        for limit in (1, 200):
+            response = client.get(f"{path}{'&' if '?' in path else '?'}limit={limit}")
+            counts.append(int(response.headers['X-Query-Count']))
+        same = counts[0] == counts[1]
+        print(f"{'ok  ' if same else 'FAIL'} {path}: {counts[0]} queries at limit=1, {counts[1]} at limit=200")
+        if not same:
+            failures.append(f'{path} grows with the page')
+
+    batch = {'add': [{'type': group, 'id': i} for group in ('characters', 'planets', 'vehicles') for i in (2, 4)],
+             'remove': [{'type': 'planets', 'id': 3}]}
+    for path, method, body in (('/users/1/favorites/planets/3/add', 'post', None),
+                               ('/users/1/favorites/1/delete', 'delete', None),
+                               ('/users/2/favorites/batch', 'post', batch)):
+        try:
+            response = getattr(client, method)(path, json=body)
+            print(f"{method.upper()} {path:<{47 - len(method)}}{response.headers['X-Query-Count']:>8}")
+        except QueryBudgetExceeded as error:
+            print(f"{path:<52} FAIL {error}")
+            failures.append(path)
+    lazy = [m for m in captured.messages if m.startswith('lazy load')]
+    if lazy:
+        failures.append(f'{len(lazy)} lazy loads')
+        print('\n'.join(lazy))
+
+    captured.messages.clear()
+    try:
+        client.get('/naive/characters')
+        failures.append('N+1 route went through')
+    except QueryBudgetExceeded as error:
+        print(f'\nN+1 route: {error}')
+    for kind in ('lazy load of Character.vehicles', 'ran the same statement 20 times'):
+        found = [m for m in captured.messages if kind in m]
+        print(f"{'ok  ' if found else 'FAIL'} logged: {kind}")
+        if not found:
+            failures.append(kind)
+    print(next(m for m in captured.messages if m.startswith('lazy load')))
+
+    if failures:
+        print(f"\nfailed: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Query-plan regression check for the read routes, on a throwaway SQLite
+database.
+
+    $ pipenv run python benchmarks/query_plans.py
+
+Every route is requested with both serializers and the entity/response
+caches cleared, and each SELECT it issued is run again through EXPLAIN QUERY
+PLAN. A full scan (SCAN <table>) is only accepted on the collection a list
+route pages through; anywhere else it means a lookup lost its index, and
+the script exits with status 1.
+"""
+import os
+import re
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+from dataset import load_app, seed
+
+# route -> tables it may scan (the paged collection, bounded by LIMIT)
+ROUTES = [
+    ('/users', {'user'}),
+    ('/users?expand=favorites', {'user'}),
+    ('/users/3', set()),
+    ('/users/3?expand=favorites', set()),
+    ('/users/3/favorites', set()),
+    ('/users/3/favorites?expand=favorites', set()),
+    ('/characters', {'character'}),
+    ('/characters?cursor=WzEwXQ', {'character'}),
+    ('/characters?fields=id,name,url', {'character'}),
+    ('/characters?gender=female&mass_in_kg[gt]=80&sort=-mass_in_kg', {'character'}),
+    ('/characters?planet_id=3', {'character'}),
+    ('/characters/7', set()),
+    ('/characters/7/vehicles', set()),
+    ('/planets', {'planet'}),
+    ('/planets?climate=arid&sort=-population', {'planet'}),
+    ('/planets/7', set()),
+    ('/vehicles', {'vehicle'}),
+    ('/vehicles?vehicle_class=speeder', {'vehicle'}),
+    ('/vehicles/7', set()),
+    ('/vehicles/7/characters', set()),
+]
+
+
+def scanned_tables(plan):
+    for row in plan:
+        detail = row[-1]
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if match and match.group(1) != 'CONSTANT':
+            # joined eager loads alias their tables as <table>_1
+            yield re.sub(r'_\d+$', '', match.group(1)), detail
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), 'plans.db')
+    app, db = load_app(f'sqlite:///{path}')
+    from cache import response_cache, entity_cache
+
+    statements = []
+    with app.app_context():
+        seed(db, characters=2000, vehicles=200, planets=100, users=20)
+        engine = db.engine
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+    client = app.test_client()
+    failures = 0
+    for serializer in ('orm', 'fast'):
+        app.config['SERIALIZER'] = serializer
+        for route, allowed in ROUTES:
+            response_cache.clear()
+            entity_cache.clear()
+            del statements[:]
+            status = client.get(route).status_code
+            raw = engine.raw_connection()
+            try:
+                for statement, parameters in statements:
+                    plan = raw.cursor().execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                    for table, detail in scanned_tables(plan):
+                        if table not in allowed:
+                            failures += 1
+                            print(f"FAIL [{serializer}] {route}: {detail}\n    {' '.join(statement.split())}")
+            finally:
+                raw.close()
+            print(f"ok   [{serializer}] {route} ({status}, {len(statements)} queries)")
+    if failures:
+        print(f"{failures} queries fell back to a full table scan")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
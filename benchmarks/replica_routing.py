@@ -0,0 +1,79 @@
+"""
+Checks the read-replica routing locally, with two SQLite files standing in
+for the primary and the replica.
+
+    $ pipenv run python benchmarks/replica_routing.py
+
+The replica starts as a copy of the primary, then each side gets a planet
+the other doesn't have, so every response shows which database served it.
+Replication never happens here: a write stays visible only where the
+routing sends reads to the primary.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dataset import load_app, seed
+
+WINDOW = 1.0
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    primary = os.path.join(folder, 'primary.db')
+    replica = os.path.join(folder, 'replica.db')
+    os.environ['REPLICA_DATABASE_URL'] = f'sqlite:///{replica}'
+    app, db = load_app(f'sqlite:///{primary}', READ_YOUR_WRITES=WINDOW)
+    from models import Planet
+    with app.app_context():
+        seed(db, characters=50, vehicles=10, planets=10, users=2, favorites_per_user=0)
+        db.session.remove()
+        db.get_engine(app).dispose()
+        shutil.copy(primary, replica)
+        for bind, name in ((None, 'only on primary'), ('replica', 'only on replica')):
+            db.get_engine(app, bind=bind).execute(Planet.__table__.insert().values(name=name))
+
+    failures = []
+
+    def check(label, condition):
+        print(f"{'ok  ' if condition else 'FAIL'} {label}")
+        if not condition:
+            failures.append(label)
+
+    def planet_names(client, path='/planets?limit=200'):
+        return {p['name'] for p in client.get(path).get_json()}
+
+    def favorite_count(client):
+        return len(client.get('/users/1/favorites').get_json())
+
+    writer = app.test_client()
+    check('GET reads from the replica', 'only on replica' in planet_names(writer))
+    app.config['SERIALIZER'] = 'fast'
+    check('the fast serializer reads from the replica too', 'only on replica' in planet_names(writer, '/planets?limit=100'))
+    app.config['SERIALIZER'] = 'orm'
+    admin = writer.get('/admin/planet/').get_data(as_text=True)
+    check('the admin reads from the primary', 'only on primary' in admin and 'only on replica' not in admin)
+
+    response = writer.post('/users/1/favorites/planets/1/add')
+    check('the write goes to the primary', response.status_code == 200 and 'error' not in response.get_json())
+    check('other clients of this process read it back (recently written table)',
+          favorite_count(app.test_client()) == 1)
+    # as if the next request of the writer landed on another worker
+    import replica
+    replica._recent_tables.clear()
+    check('the writer reads its write back anywhere (cookie)', favorite_count(writer) == 1)
+
+    time.sleep(WINDOW + 0.2)
+    from cache import response_cache, entity_cache
+    response_cache.clear()
+    entity_cache.clear()
+    check('after the window reads are back on the (stale) replica', favorite_count(app.test_client()) == 0)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+/search latency on a synthetic catalog, on a throwaway SQLite database.
+
+    $ pipenv run python benchmarks/search.py --rows 50000
+
+Runs a set of queries against the SQLite FTS5 index (created by its
+migration) and the in-process inverted index, and prints the median and p95
+time per request of each, plus the time the in-process index takes to load.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from dataset import ROOT, load_app, seed
+
+QUERIES = ['arid', 'desert', 'incom', 'aratech speeder', 'blue male', 'character 4242', 'planet 17',
+           'grasslands mountains', 'gold', 'nothing matches this']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000, help='rows per catalog table')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=21)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'search.db')
+    app, db = load_app(f'sqlite:///{path}')
+    import flask_migrate
+    from cache import response_cache
+    from search import memory_index
+    with app.app_context():
+        seed(db, characters=args.rows, vehicles=args.rows, planets=args.rows, users=0)
+        # create_all() made the tables, only the search migration is applied
+        migrations = os.path.join(ROOT, 'migrations')
+        flask_migrate.stamp(migrations, revision='a41c7e29d5b3')
+        flask_migrate.upgrade(migrations, revision='c7d2f1a9b864')
+        fts = db.engine.has_table('search_index')
+
+    client = app.test_client()
+
+    def timed(url):
+        times = []
+        for _ in range(args.repeat):
+            response_cache.clear()
+            start = time.perf_counter()
+            response = client.get(url)
+            times.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.data
+        times.sort()
+        return statistics.median(times) * 1000, times[int(len(times) * 0.95) - 1] * 1000, len(response.get_json())
+
+    app.config['SEARCH_BACKEND'] = 'memory'
+    start = time.perf_counter()
+    client.get('/search?q=warmup')
+    print(f"in-process index: loaded {args.rows * 3} rows in {time.perf_counter() - start:.2f}s")
+
+    backends = (['fts'] if fts else []) + ['memory']
+    print(f"{'query':<24}" + ''.join(f"{b + ' p50':>12}{b + ' p95':>12}{'hits':>6}" for b in backends))
+    for q in QUERIES:
+        line = f"{q:<24}"
+        for backend in backends:
+            app.config['SEARCH_BACKEND'] = backend
+            p50, p95, hits = timed(f'/search?q={q}&limit={args.limit}')
+            line += f"{p50:>9.2f} ms{p95:>9.2f} ms{hits:>6}"
+        print(line)
+    if not fts:
+        print('(this SQLite build has no FTS5, only the in-process index was measured)')
+    memory_index.clear()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares the ORM serialize() path with the column-oriented fast_serializer on
+the catalog list routes, on a throwaway SQLite database.
+
+    $ pipenv run python benchmarks/serializer.py --rows 20000 --page 1000
+
+For every model it checks that both engines return the same bytes and prints
+the median time per page and the speedup.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from dataset import load_app, seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='rows per catalog table')
+    parser.add_argument('--page', type=int, default=1000, help='page size requested from the routes')
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app, db = load_app(f'sqlite:///{path}', MAX_PAGE_SIZE=args.page)
+    from cache import response_cache, entity_cache
+    with app.app_context():
+        seed(db, characters=args.rows, vehicles=args.rows, planets=args.rows, users=0)
+
+    client = app.test_client()
+
+    def timed(url, engine):
+        app.config['SERIALIZER'] = engine
+        times = []
+        for _ in range(args.repeat):
+            response_cache.clear()
+            entity_cache.clear()
+            start = time.perf_counter()
+            body = client.get(url).get_data()
+            times.append(time.perf_counter() - start)
+        return statistics.median(times), body
+
+    print(f"{args.rows} rows per table, {args.page} rows per page, median of {args.repeat}")
+    print(f"{'route':<32}{'orm ms':>10}{'fast ms':>10}{'speedup':>10}  identical")
+    for route in ('/planets', '/vehicles', '/characters', '/characters?fields=id,name,url'):
+        url = route + ('&' if '?' in route else '?') + f'limit={args.page}'
+        orm, orm_body = timed(url, 'orm')
+        fast, fast_body = timed(url, 'fast')
+        print(f"{route:<32}{orm * 1000:>10.1f}{fast * 1000:>10.1f}{orm / fast:>9.1f}x  {orm_body == fast_body}")
+
+
+if __name__ == '__main__':
+    main()
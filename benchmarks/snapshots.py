@@ -0,0 +1,92 @@
+"""
+Cold-client bootstrap: paging through /planets, /vehicles and /characters
+against downloading their snapshots (snapshots.py), on a throwaway SQLite
+database through the Flask test client, caches off.
+
+    $ pipenv run python benchmarks/snapshots.py --characters 20000
+
+Prints the snapshot build time, then for each way the requests, the bytes on
+the wire (gzip), the database queries and the time; the rows must be the
+same both ways. Under gunicorn the snapshot files are also sent with
+sendfile(), which the test client does not show.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+
+from dataset import load_app, seed
+
+COLLECTIONS = ('planets', 'vehicles', 'characters')
+
+
+def paged(client, limit):
+    rows, requests, size, queries = {}, 0, 0, 0
+    for name in COLLECTIONS:
+        rows[name] = []
+        path = f'/{name}?limit={limit}'
+        while path:
+            response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+            requests += 1
+            size += len(response.data)
+            queries += int(response.headers['X-Query-Count'])
+            rows[name].extend(response.get_json())
+            link = response.headers.get('Link')
+            path = link[link.index('<') + 1:link.index('>')].split('localhost', 1)[1] if link else None
+    return rows, requests, size, queries
+
+
+def snapshot(client):
+    rows, requests, size, queries = {}, 1, 0, 0
+    response = client.get('/snapshots')
+    queries += int(response.headers['X-Query-Count'])
+    files = response.get_json()['files']
+    for name in COLLECTIONS:
+        response = client.get(files[f'{name}.ndjson']['url'], headers={'Accept-Encoding': 'gzip'})
+        requests += 1
+        size += len(response.data)
+        queries += int(response.headers['X-Query-Count'])
+        body = gzip.decompress(response.data) if response.headers.get('Content-Encoding') == 'gzip' else response.data
+        rows[name] = [json.loads(line) for line in body.splitlines()]
+    return rows, requests, size, queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--characters', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=200, help='page size of the list routes')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    app, db = load_app(f"sqlite:///{os.path.join(folder, 'snapshots.db')}", SNAPSHOT_DIR=os.path.join(folder, 'snapshots'),
+                       RESPONSE_CACHE_SIZE=0, ENTITY_CACHE_SIZE=0, MAX_PAGE_SIZE=args.limit,
+                       QUERY_DEBUG='log', QUERY_REPEATS=1000000)
+    from snapshots import snapshots
+    with app.app_context():
+        seed(db, characters=args.characters, vehicles=args.characters // 10, planets=max(60, args.characters // 100))
+        start = time.perf_counter()
+        manifest = snapshots.build()
+        print(f"snapshot {manifest['version']} built in {time.perf_counter() - start:.1f}s: " + ', '.join(
+            f"{name} {info['size'] // 1024} KB (gzip {info['encodings']['gzip'] // 1024} KB)"
+            for name, info in manifest['files'].items() if name.endswith('.ndjson')))
+        db.session.remove()
+    client = app.test_client()
+
+    print(f"{'bootstrap':<12}{'requests':>10}{'KB':>10}{'queries':>10}{'ms':>10}")
+    results = {}
+    for label, fetch in (('paged', lambda: paged(client, args.limit)), ('snapshot', lambda: snapshot(client))):
+        start = time.perf_counter()
+        rows, requests, size, queries = fetch()
+        elapsed = time.perf_counter() - start
+        results[label] = rows
+        print(f"{label:<12}{requests:>10}{size // 1024:>10}{queries:>10}{elapsed * 1000:>10.0f}")
+    if results['paged'] != results['snapshot']:
+        print('the snapshot differs from the list routes')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
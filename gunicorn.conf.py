@@ -0,0 +1,69 @@
+"""
+Gunicorn settings for production (Procfile, render.yml):
+
+    $ gunicorn wsgi --config gunicorn.conf.py
+
+GUNICORN_WORKLOAD picks the worker model:
+  - io (default): gthread workers, cpu + 1 of them, each with one thread per
+    pooled database connection; requests mostly wait on the database
+  - cpu: sync workers, 2 * cpu + 1 of them
+
+WEB_CONCURRENCY, GUNICORN_THREADS and GUNICORN_WORKER_CLASS override the
+derived values.
+"""
+import gc
+import multiprocessing
+import os
+
+cpus = multiprocessing.cpu_count()
+workload = os.getenv('GUNICORN_WORKLOAD', 'io')
+
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+if workload == 'cpu':
+    workers = int(os.getenv('WEB_CONCURRENCY', cpus * 2 + 1))
+    threads = int(os.getenv('GUNICORN_THREADS', 1))
+else:
+    workers = int(os.getenv('WEB_CONCURRENCY', cpus + 1))
+    # more threads than pooled connections would only queue on the pool
+    threads = int(os.getenv('GUNICORN_THREADS', int(os.getenv('DB_POOL_SIZE', 2)) + int(os.getenv('DB_MAX_OVERFLOW', 3))))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+
+# the app (models, mappers, admin views...) is imported once in the master
+# and shared copy-on-write by the workers
+preload_app = True
+
+# above the 15s statement timeout (DB_STATEMENT_TIMEOUT), so a slow query
+# fails with a database error before its worker gets killed
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# recycle workers every ~1000 requests to bound memory creep (caches, the
+# search index, fragmentation); the jitter keeps them from restarting together
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# heartbeat files on tmpfs, a disk-backed /tmp can stall workers in containers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG')
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+
+def when_ready(server):
+    # everything allocated while preloading stays out of the garbage
+    # collector, whose bookkeeping would otherwise un-share those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # connections opened by the master while preloading must not be shared
+    # with the workers: drop them, each worker opens its own
+    from app import app
+    from models import db
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+            db.get_engine(app, bind=bind).dispose()
@@ -32,6 +32,18 @@ target_db = current_app.extensions['migrate'].db
 # ... etc.
 
 
+def include_name(name, type_, parent_names):
+    # the SQLite FTS5 table behind /search (and its shadow tables) and the
+    # Postgres tsvector indexes are managed by hand in their migration,
+    # autogenerate must not try to drop them; nor sqlite_sequence, SQLite's
+    # own bookkeeping for the AUTOINCREMENT of change_log
+    if type_ == 'table':
+        return not name.startswith('search_index') and name != 'sqlite_sequence'
+    if type_ == 'index':
+        return not (name or '').endswith('_search')
+    return True
+
+
 def get_metadata():
     if hasattr(target_db, 'metadatas'):
         return target_db.metadatas[None]
@@ -84,6 +96,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            include_name=include_name,
             **current_app.extensions['migrate'].configure_args
         )
 
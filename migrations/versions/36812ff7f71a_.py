@@ -0,0 +1,57 @@
+"""add foreign key and favorite uniqueness indexes
+
+Revision ID: 36812ff7f71a
+Revises: 2b88ac1672a4
+Create Date: 2026-10-18 10:42:17.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '36812ff7f71a'
+down_revision = '2b88ac1672a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # duplicate favorites would make the unique indexes fail, keep the oldest
+    for target in ('character_id', 'planet_id', 'vehicle_id'):
+        op.execute(
+            f"DELETE FROM favorite WHERE {target} IS NOT NULL AND id NOT IN "
+            f"(SELECT MIN(id) FROM favorite WHERE {target} IS NOT NULL GROUP BY user_id, {target})"
+        )
+
+    with op.batch_alter_table('character', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_character_planet_id'), ['planet_id'], unique=False)
+
+    with op.batch_alter_table('character_x_vehicle', schema=None) as batch_op:
+        batch_op.create_index('ix_character_x_vehicle_character_id_vehicle_id', ['character_id', 'vehicle_id'], unique=False)
+        batch_op.create_index('ix_character_x_vehicle_vehicle_id', ['vehicle_id'], unique=False)
+
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.create_index('uq_favorite_user_id_character_id', ['user_id', 'character_id'], unique=True)
+        batch_op.create_index('uq_favorite_user_id_planet_id', ['user_id', 'planet_id'], unique=True)
+        batch_op.create_index('uq_favorite_user_id_vehicle_id', ['user_id', 'vehicle_id'], unique=True)
+        batch_op.create_index('ix_favorite_character_id', ['character_id'], unique=False)
+        batch_op.create_index('ix_favorite_planet_id', ['planet_id'], unique=False)
+        batch_op.create_index('ix_favorite_vehicle_id', ['vehicle_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.drop_index('ix_favorite_vehicle_id')
+        batch_op.drop_index('ix_favorite_planet_id')
+        batch_op.drop_index('ix_favorite_character_id')
+        batch_op.drop_index('uq_favorite_user_id_vehicle_id')
+        batch_op.drop_index('uq_favorite_user_id_planet_id')
+        batch_op.drop_index('uq_favorite_user_id_character_id')
+
+    with op.batch_alter_table('character_x_vehicle', schema=None) as batch_op:
+        batch_op.drop_index('ix_character_x_vehicle_vehicle_id')
+        batch_op.drop_index('ix_character_x_vehicle_character_id_vehicle_id')
+
+    with op.batch_alter_table('character', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_character_planet_id'))
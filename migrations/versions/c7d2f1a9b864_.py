@@ -0,0 +1,66 @@
+"""full-text search indexes for /search
+
+Revision ID: c7d2f1a9b864
+Revises: a41c7e29d5b3
+Create Date: 2026-10-18 16:21:08.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2f1a9b864'
+down_revision = 'a41c7e29d5b3'
+branch_labels = None
+depends_on = None
+
+# table -> (rowid code, body columns); keep in sync with search.py
+DOCUMENTS = {
+    'planet': (1, ['climate', 'terrain']),
+    'vehicle': (2, ['model', 'vehicle_class', 'manufacturer']),
+    'character': (3, ['gender', 'hair_color', 'skin_color', 'eye_color'])
+}
+
+
+def _body(columns, row=''):
+    return " || ' ' || ".join(f"coalesce({row}{column}, '')" for column in columns)
+
+
+def _pg_document(columns):
+    return (f"setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+            f"setweight(to_tsvector('simple', {_body(columns)}), 'B')")
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        for table, (_, columns) in DOCUMENTS.items():
+            op.execute(f'CREATE INDEX ix_{table}_search ON "{table}" USING gin (({_pg_document(columns)}))')
+    elif bind.dialect.name == 'sqlite':
+        # without FTS5 /search falls back to its in-process index
+        if not bind.execute(sa.text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar():
+            return
+        # one row per catalog row, rowid = id * 4 + code, kept up to date by triggers
+        op.execute("CREATE VIRTUAL TABLE search_index USING fts5(name, body)")
+        for table, (code, columns) in DOCUMENTS.items():
+            insert = (f"INSERT INTO search_index (rowid, name, body) "
+                      f"VALUES (new.id * 4 + {code}, new.name, {_body(columns, 'new.')});")
+            delete = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code};"
+            op.execute(f'CREATE TRIGGER search_index_{table}_insert AFTER INSERT ON "{table}" BEGIN {insert} END')
+            op.execute(f'CREATE TRIGGER search_index_{table}_update AFTER UPDATE ON "{table}" BEGIN {delete} {insert} END')
+            op.execute(f'CREATE TRIGGER search_index_{table}_delete AFTER DELETE ON "{table}" BEGIN {delete} END')
+            op.execute(f'INSERT INTO search_index (rowid, name, body) '
+                       f'SELECT id * 4 + {code}, name, {_body(columns)} FROM "{table}"')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        for table in DOCUMENTS:
+            op.execute(f'DROP INDEX IF EXISTS ix_{table}_search')
+    elif bind.dialect.name == 'sqlite':
+        for table in DOCUMENTS:
+            for action in ('insert', 'update', 'delete'):
+                op.execute(f'DROP TRIGGER IF EXISTS search_index_{table}_{action}')
+        op.execute('DROP TABLE IF EXISTS search_index')
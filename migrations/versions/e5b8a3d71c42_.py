@@ -0,0 +1,145 @@
+"""change_log, and the triggers that fill it, for /changes
+
+Revision ID: e5b8a3d71c42
+Revises: c7d2f1a9b864
+Create Date: 2026-10-18 18:42:17.203551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8a3d71c42'
+down_revision = 'c7d2f1a9b864'
+branch_labels = None
+depends_on = None
+
+# the columns of the tracked tables at this revision; keep the rest in sync
+# with changes.py
+COLUMNS = {
+    'planet': ['id', 'name', 'url', 'diameter_in_km', 'rotation_period_in_days', 'orbital_period_in_days',
+               'gravity_in_g', 'population', 'climate', 'terrain', 'surface_water_percent'],
+    'vehicle': ['id', 'name', 'url', 'model', 'vehicle_class', 'manufacturer', 'cost_in_credits', 'length_in_m',
+                'crew', 'passengers', 'max_atmosphering_speed_in_kmh', 'cargo_capacity_in_kg'],
+    'character': ['id', 'name', 'url', 'height_in_cm', 'mass_in_kg', 'hair_color', 'skin_color', 'eye_color',
+                  'birthyear', 'gender', 'planet_id'],
+    'favorite': ['id', 'user_id', 'character_id', 'planet_id', 'vehicle_id'],
+}
+
+# table -> the rows that embed its name: (their table, id, user id, from, where column)
+EMBEDDED = {
+    'planet': [('favorite', 'id', 'user_id', 'favorite', 'planet_id')],
+    'vehicle': [('favorite', 'id', 'user_id', 'favorite', 'vehicle_id'),
+                ('character', 'character_id', 'NULL', 'character_x_vehicle', 'vehicle_id')],
+    'character': [('favorite', 'id', 'user_id', 'favorite', 'character_id'),
+                  ('vehicle', 'vehicle_id', 'NULL', 'character_x_vehicle', 'character_id')],
+    'favorite': [],
+}
+# a vehicle link changes both its character and its vehicle
+LINKS = {'character_x_vehicle': ['character', 'vehicle']}
+
+
+def _log(dialect, values, source=''):
+    if dialect == 'postgresql':
+        return (f"INSERT INTO change_log (txid, table_name, row_id, op, user_id) "
+                f"SELECT txid_current(), {values}{source};")
+    return f"INSERT INTO change_log (table_name, row_id, op, user_id) SELECT {values}{source};"
+
+def _row_log(dialect, table, row, op=None):
+    # op None is the operation of the Postgres trigger
+    user_id = f'{row}.user_id' if table == 'favorite' else 'NULL'
+    op = f"'{op}'" if op else 'lower(TG_OP)'
+    return _log(dialect, f"'{table}', {row}.id, {op}, {user_id}")
+
+def _embedded_logs(dialect, table, row, condition=''):
+    return ' '.join(_log(dialect, f"'{target}', {id_column}, 'update', {user_id}",
+                         f" FROM {source} WHERE {column} = {row}.id{condition}")
+                    for target, id_column, user_id, source, column in EMBEDDED[table])
+
+def _link_logs(dialect, table, row):
+    return ' '.join(_log(dialect, f"'{target}', {row}.{target}_id, 'update', NULL") for target in LINKS[table])
+
+
+def trigger_statements(dialect, columns):
+    # columns is table -> its column names; SQLite only logs the updates
+    # that change one of them
+    statements = []
+    if dialect == 'postgresql':
+        for table in EMBEDDED:
+            embedded = ''
+            if EMBEDDED[table]:
+                # nested: OLD is not assigned in an INSERT trigger
+                embedded = (f"IF TG_OP = 'UPDATE' THEN IF OLD.name IS DISTINCT FROM NEW.name THEN "
+                            f"{_embedded_logs(dialect, table, 'NEW')} END IF; END IF; ")
+            statements.append(
+                f"CREATE OR REPLACE FUNCTION change_log_{table}() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP = 'DELETE' THEN {_row_log(dialect, table, 'OLD', 'delete')} "
+                f"ELSE {_row_log(dialect, table, 'NEW')} END IF; "
+                f"{embedded}RETURN NULL; END $$ LANGUAGE plpgsql")
+            statements.append(f'CREATE TRIGGER change_log_{table} AFTER INSERT OR DELETE ON "{table}" '
+                              f'FOR EACH ROW EXECUTE PROCEDURE change_log_{table}()')
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" '
+                              f'FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE change_log_{table}()')
+        for table in LINKS:
+            statements.append(
+                f"CREATE OR REPLACE FUNCTION change_log_{table}() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP <> 'INSERT' THEN {_link_logs(dialect, table, 'OLD')} END IF; "
+                f"IF TG_OP <> 'DELETE' THEN {_link_logs(dialect, table, 'NEW')} END IF; "
+                f"RETURN NULL; END $$ LANGUAGE plpgsql")
+            statements.append(f'CREATE TRIGGER change_log_{table} AFTER INSERT OR UPDATE OR DELETE ON "{table}" '
+                              f'FOR EACH ROW EXECUTE PROCEDURE change_log_{table}()')
+    elif dialect == 'sqlite':
+        for table in EMBEDDED:
+            changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in columns[table])
+            embedded = _embedded_logs(dialect, table, 'new', ' AND old.name IS NOT new.name') if EMBEDDED[table] else ''
+            statements.append(f'CREATE TRIGGER change_log_{table}_insert AFTER INSERT ON "{table}" '
+                              f"BEGIN {_row_log(dialect, table, 'new', 'insert')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" WHEN {changed} '
+                              f"BEGIN {_row_log(dialect, table, 'new', 'update')} {embedded} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_delete AFTER DELETE ON "{table}" '
+                              f"BEGIN {_row_log(dialect, table, 'old', 'delete')} END")
+        for table in LINKS:
+            statements.append(f'CREATE TRIGGER change_log_{table}_insert AFTER INSERT ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'new')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'old')} {_link_logs(dialect, table, 'new')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_delete AFTER DELETE ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'old')} END")
+    return statements
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('txid', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    with op.batch_alter_table('change_log', schema=None) as batch_op:
+        batch_op.create_index('ix_change_log_txid_id', ['txid', 'id'], unique=False)
+
+    # the log starts empty: clients bootstrap from the collections
+    for statement in trigger_statements(op.get_bind().dialect.name, COLUMNS):
+        op.execute(statement)
+
+
+def downgrade():
+    bind = op.get_bind()
+    for table in list(EMBEDDED) + list(LINKS):
+        if bind.dialect.name == 'postgresql':
+            op.execute(f'DROP TRIGGER IF EXISTS change_log_{table} ON "{table}"')
+            op.execute(f'DROP TRIGGER IF EXISTS change_log_{table}_update ON "{table}"')
+            op.execute(f'DROP FUNCTION IF EXISTS change_log_{table}()')
+        elif bind.dialect.name == 'sqlite':
+            for action in ('insert', 'update', 'delete'):
+                op.execute(f'DROP TRIGGER IF EXISTS change_log_{table}_{action}')
+    with op.batch_alter_table('change_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_change_log_txid_id')
+
+    op.drop_table('change_log')
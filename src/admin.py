@@ -1,14 +1,18 @@
 import os
-from flask_admin import Admin
+import threading
+from flask import Flask
 from models import db, User, Planet, Character, Vehicle, Character_X_Vehicle, Favorite
-from flask_admin.contrib.sqla import ModelView
 
-def setup_admin(app):
+def setup_admin(app, url='/admin'):
+    # flask_admin is only imported when the admin is actually set up
+    from flask_admin import Admin
+    from flask_admin.contrib.sqla import ModelView
+
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
-    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
+    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3', url=url)
+
 
-    
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
     admin.add_view(ModelView(Planet, db.session))
@@ -18,4 +22,41 @@ def setup_admin(app):
     admin.add_view(ModelView(Favorite, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
+
+
+class LazyAdmin:
+    # WSGI middleware for API_ONLY mode: requests under /admin go to a separate
+    # Flask app holding Flask-Admin, built on the first of them, so workers
+    # that never serve the admin never import or set it up. The admin app
+    # always uses the primary database.
+
+    def __init__(self, app, prefix='/admin'):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.prefix = prefix
+        self._admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path != self.prefix and not path.startswith(self.prefix + '/'):
+            return self.wsgi_app(environ, start_response)
+        environ = dict(environ, SCRIPT_NAME=environ.get('SCRIPT_NAME', '') + self.prefix,
+                       PATH_INFO=path[len(self.prefix):])
+        return self.admin_app()(environ, start_response)
+
+    def admin_app(self):
+        with self._lock:
+            if self._admin_app is None:
+                admin_app = Flask(self.app.import_name)
+                admin_app.config.update(self.app.config)
+                admin_app.config['SQLALCHEMY_BINDS'] = None
+                db.init_app(admin_app)
+                setup_admin(admin_app, url='/')
+                self._admin_app = admin_app
+            return self._admin_app
+
+
+def setup_lazy_admin(app):
+    app.wsgi_app = LazyAdmin(app)
@@ -2,14 +2,30 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from functools import partial
+from flask import Flask, Response, request, jsonify, url_for
 from flask_cors import CORS
 import json
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from utils import APIException, generate_sitemap, page_params, paginate, paginated_response, wants_stream, streamed_response, wants_expanded, fields_param, wants_ndjson, order_clauses, encode_cursor, ops_only
+from filters import filter_params, sort_param
+from admin import setup_admin, setup_lazy_admin
+from cache import setup_cache, cached_response
 from models import db, User, Character, Planet, Vehicle, Character_X_Vehicle, Favorite
+from models import (character_load_plan, planet_load_plan, vehicle_load_plan, user_load_plan,
+                    favorite_load_plan, serialize_entity, serialize_entities, expand_favorites, expand_users,
+                    field_names, fields_load_plan, serialize_fields)
+from cache import entity_cache
+from ingest import request_rows, bulk_upsert
+from favorites import setup_favorites, favorite_batch_params, write_favorites, TARGETS as FAVORITE_TARGETS
+from commands import setup_commands
+from search import setup_search, search_params, find
+from changes import changes_params, read_changes, head
+from snapshots import setup_snapshots, snapshot_manifest, snapshot_response
+from pool import engine_options, pool_stats
+from replica import setup_replica
+from metrics import setup_metrics, metrics
+from query_budget import setup_query_budget, query_budget
+import fast_serializer
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -20,11 +36,73 @@ if db_url is not None:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# production: the admin is mounted on its first request and Flask-Migrate is
+# only loaded for the flask CLI, so workers boot faster
+app.config['API_ONLY'] = os.getenv("API_ONLY", "false").lower() in ("1", "true")
+# GET requests read from the replica when there is one, see replica.py
+replica_url = os.getenv("REPLICA_DATABASE_URL")
+if replica_url is not None:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_url.replace("postgres://", "postgresql://")}
+app.config['READ_YOUR_WRITES'] = float(os.getenv("READ_YOUR_WRITES", 5))
+# connection pool, per worker process (ignored for SQLite), see pool.py
+app.config['DB_POOL_SIZE'] = int(os.getenv("DB_POOL_SIZE", 2))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv("DB_MAX_OVERFLOW", 3))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv("DB_POOL_TIMEOUT", 10))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv("DB_POOL_RECYCLE", 1800))
+app.config['DB_POOL_PRE_PING'] = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true")
+# milliseconds, 0 disables it (Postgres only)
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.getenv("DB_STATEMENT_TIMEOUT", 15000))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+app.config['PAGE_SIZE'] = int(os.getenv("PAGE_SIZE", 50))
+app.config['MAX_PAGE_SIZE'] = int(os.getenv("MAX_PAGE_SIZE", 200))
+app.config['STREAM_CHUNK_SIZE'] = int(os.getenv("STREAM_CHUNK_SIZE", 500))
+app.config['RESPONSE_CACHE_SIZE'] = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+app.config['RESPONSE_CACHE_TTL'] = int(os.getenv("RESPONSE_CACHE_TTL", 60))
+app.config['ENTITY_CACHE_SIZE'] = int(os.getenv("ENTITY_CACHE_SIZE", 4096))
+app.config['ENTITY_CACHE_TTL'] = int(os.getenv("ENTITY_CACHE_TTL", 300))
+app.config['INGEST_CHUNK_SIZE'] = int(os.getenv("INGEST_CHUNK_SIZE", 1000))
+app.config['FAVORITES_BATCH_SIZE'] = int(os.getenv("FAVORITES_BATCH_SIZE", 500))
+# favorite writes committed together by a writer thread, see group_commit.py
+app.config['FAVORITES_GROUP_COMMIT'] = os.getenv("FAVORITES_GROUP_COMMIT", "false").lower() in ("1", "true")
+app.config['FAVORITES_COMMIT_WINDOW_MS'] = float(os.getenv("FAVORITES_COMMIT_WINDOW_MS", 5))
+app.config['FAVORITES_COMMIT_MAX_BATCH'] = int(os.getenv("FAVORITES_COMMIT_MAX_BATCH", 64))
+app.config['FAVORITES_COMMIT_TIMEOUT'] = float(os.getenv("FAVORITES_COMMIT_TIMEOUT", 10))
+# "orm" (serialize()) or "fast" (fast_serializer) for the catalog list routes
+app.config['SERIALIZER'] = os.getenv("SERIALIZER", "orm")
+# "auto" (FTS5/tsvector when the search migration ran, else in-process), "fts", "postgres" or "memory"
+app.config['SEARCH_BACKEND'] = os.getenv("SEARCH_BACKEND", "auto")
+app.config['SEARCH_INDEX_TTL'] = int(os.getenv("SEARCH_INDEX_TTL", 300))
+# per-endpoint latency, query and response size metrics at /metrics, see metrics.py
+app.config['METRICS'] = os.getenv("METRICS", "true").lower() in ("1", "true")
+# bearer token for /metrics, /cache/stats and /pool/stats; without one they are
+# not served when API_ONLY is set, see utils.ops_only
+app.config['OPS_TOKEN'] = os.getenv("OPS_TOKEN")
+# development and tests: "log" or "raise" on N+1 patterns and routes over their query budget, see query_budget.py
+app.config['QUERY_DEBUG'] = os.getenv("QUERY_DEBUG", "off")
+app.config['QUERY_REPEATS'] = int(os.getenv("QUERY_REPEATS", 3))
+# prebuilt, precompressed catalog files served at /snapshots, see snapshots.py
+app.config['SNAPSHOT_DIR'] = os.getenv("SNAPSHOT_DIR", "/tmp/snapshots")
+app.config['SNAPSHOT_CHECK_INTERVAL'] = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", 10))
+app.config['SNAPSHOT_KEEP'] = int(os.getenv("SNAPSHOT_KEEP", 3))
+app.config['SNAPSHOT_BROTLI_QUALITY'] = int(os.getenv("SNAPSHOT_BROTLI_QUALITY", 9))
 
-MIGRATE = Migrate(app, db)
+if not app.config['API_ONLY'] or os.getenv("FLASK_RUN_FROM_CLI") == "true":
+    from flask_migrate import Migrate
+    MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
-setup_admin(app)
+if app.config['API_ONLY']:
+    setup_lazy_admin(app)
+else:
+    setup_admin(app)
+setup_cache(app)
+setup_commands(app)
+setup_search(app)
+setup_replica(app)
+setup_metrics(app)
+setup_query_budget(app)
+setup_favorites(app)
+setup_snapshots(app)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -35,20 +113,33 @@ def handle_invalid_usage(error):
 # --------------------------------------------------
 
 @app.route('/users', methods=['GET'])
+@query_budget(10)
 def get_uses():
+    limit, cursor = page_params()
+    fields = fields_param(field_names(User))
+    expand = wants_expanded('favorites') and (fields is None or 'favorites' in fields)
     try:
-        users = []
-        for user in User.query.all():
-            users.append(user.serialize())
-        return jsonify(users)
+        query = User.query.options(*fields_load_plan(User, fields, user_load_plan()))
+        if wants_stream():
+            return streamed_response(query.order_by(User.id), partial(serialize_fields, fields=fields))
+        users, next_cursor = paginate(query, User.id, limit, cursor)
+        users = [serialize_fields(user, fields) for user in users]
+        if expand:
+            users = expand_users(users)
+        return paginated_response(users, next_cursor)
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/users/<int:user_id>', methods=['GET'])
+@query_budget(10)
 def get_user(user_id):
+    fields = fields_param(field_names(User))
+    expand = wants_expanded('favorites') and (fields is None or 'favorites' in fields)
     try:
-        user = User.query.get(user_id)
-        return jsonify(user.serialize())
+        user = serialize_entity(User, user_id, user_load_plan(), fields)
+        if expand:
+            user = expand_users([user])[0]
+        return jsonify(user)
     except:
         return {'error': 'Something went wrong...'}
 
@@ -58,60 +149,56 @@ def get_user(user_id):
 
 @app.route('/characters/create', methods=['POST'])
 def create_character():
-    # luke_dict = {
-    # "name": "Luke Skywalker",
-    # "url": "https://swapi.dev/api/people/1/",
-    # "height_in_cm": 172,
-    # "mass_in_kg": 77,
-    # "hair_color": "blond",
-    # "skin_color": "fair",
-    # "eye_color": "blue",
-    # "birthyear": "19BBY",
-    # "gender": "male",
-    # "planet_id": None
-    # }
-    # leia_dict = {
-    #     "name": "Leia Organa",
-    #     "url": "https://swapi.dev/api/people/5/",
-    #     "height_in_cm": 150,
-    #     "mass_in_kg": 49,
-    #     "hair_color": "brown",
-    #     "skin_color": "light",
-    #     "eye_color": "brown",
-    #     "birthyear": "19BBY",
-    #     "gender": "female",
-    #     "planet_id": None
-    # }
-    # characters_list = [luke_dict, leia_dict]
-    # characters = [Character(**char) for char in characters_list]
-    # db.session.add_all(characters)
-    # db.session.commit()
-    return {"msg": "create character"}
+    rows = request_rows()
+    try:
+        return jsonify(bulk_upsert(Character, rows, app.config['INGEST_CHUNK_SIZE']))
+    except:
+        db.session.rollback()
+        return {'error': 'Something went wrong...'}
+    finally:
+        db.session.close()
 
 @app.route('/characters', methods=['GET'])
+@query_budget(2)
+@cached_response('character', 'character_x_vehicle', 'vehicle')
 def get_characters():
+    sort = sort_param(Character)
+    criteria = filter_params(Character)
+    limit, cursor = page_params(sort)
+    fields = fields_param(field_names(Character))
     try:
-        characters = []
-        for character in Character.query.all():
-            characters.append(character.serialize())
-        return jsonify(characters)
+        if fast_serializer.enabled():
+            if wants_stream():
+                return fast_serializer.streamed_response(Character, fields, wants_ndjson(), criteria, sort)
+            return fast_serializer.page_response(Character, fields, limit, cursor, criteria, sort)
+        query = Character.query.options(*fields_load_plan(Character, fields, character_load_plan(), sort)).filter(*criteria)
+        if wants_stream():
+            return streamed_response(query.order_by(*order_clauses(Character.id, sort)), partial(serialize_fields, fields=fields))
+        characters, next_cursor = paginate(query, Character.id, limit, cursor, sort)
+        return paginated_response([serialize_fields(character, fields) for character in characters], next_cursor)
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/characters/<int:character_id>', methods=['GET'])
+@query_budget(2)
+@cached_response('character', 'character_x_vehicle', 'vehicle')
 def get_character(character_id):
+    fields = fields_param(field_names(Character))
     try:
-        character = Character.query.filter_by(id=character_id).first()
-        return jsonify(character.serialize())
+        return jsonify(serialize_entity(Character, character_id, character_load_plan(), fields))
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/characters/<int:character_id>/vehicles', methods=['GET'])
+@query_budget(4)
 # using a list comprehension to iterate through the vehicles list, extract the vehicle attribute from each Character_X_Vehicle object, and serialize it. You can then pass this list to the jsonify function to return it in the response.
+@cached_response('character', 'character_x_vehicle', 'vehicle')
 def get_character_vehicles(character_id):
+    fields = fields_param(field_names(Vehicle))
     try:
-        character = Character.query.get(character_id)
-        vehicles = [v.vehicle.serialize() for v in character.vehicles]
+        serialize_entity(Character, character_id, character_load_plan(), ['id'])
+        links = Character_X_Vehicle.query.filter_by(character_id=character_id).order_by(Character_X_Vehicle.id)
+        vehicles = serialize_entities(Vehicle, [v.vehicle_id for v in links], vehicle_load_plan(), fields)
         return jsonify(vehicles)
     except:
         return {'error': 'Something went wrong...'}
@@ -121,51 +208,43 @@ def get_character_vehicles(character_id):
 
 @app.route('/planets/create', methods=['POST'])
 def create_planet():
-    # tatooine_dict = {
-    #     "name": "Tatooine",
-    #     "url": "https://swapi.dev/api/planets/1/",
-    #     "diameter_in_km": 10465,
-    #     "rotation_period_in_days": 23,
-    #     "orbital_period_in_days": 304,
-    #     "gravity_in_g": 1,
-    #     "population": 200000,
-    #     "climate": "arid",
-    #     "terrain": "desert",
-    #     "surface_water_percent": 1
-    # }
-    # alderan_dict = {
-    #     "name": "Alderaan",
-    #     "url": "https://swapi.dev/api/planets/2/",
-    #     "diameter_in_km": 12500,
-    #     "rotation_period_in_days": 24,
-    #     "orbital_period_in_days": 364,
-    #     "gravity_in_g": 1,
-    #     "population": 2000000000,
-    #     "climate": "temperate",
-    #     "terrain": "grasslands, mountains",
-    #     "surface_water_percent": 40
-    # }
-    # planets_list = [tatooine_dict, alderan_dict]
-    # planets = [Planet(**planet) for planet in planets_list]
-    # db.session.add_all(planets)
-    # db.session.commit()
-    return {"msg": "create planet"}
+    rows = request_rows()
+    try:
+        return jsonify(bulk_upsert(Planet, rows, app.config['INGEST_CHUNK_SIZE']))
+    except:
+        db.session.rollback()
+        return {'error': 'Something went wrong...'}
+    finally:
+        db.session.close()
 
 @app.route('/planets', methods=['GET'])
+@query_budget(1)
+@cached_response('planet')
 def get_planets():
+    sort = sort_param(Planet)
+    criteria = filter_params(Planet)
+    limit, cursor = page_params(sort)
+    fields = fields_param(field_names(Planet))
     try:
-        planets = []
-        for planet in Planet.query.all():
-            planets.append(planet.serialize())
-        return jsonify(planets)
+        if fast_serializer.enabled():
+            if wants_stream():
+                return fast_serializer.streamed_response(Planet, fields, wants_ndjson(), criteria, sort)
+            return fast_serializer.page_response(Planet, fields, limit, cursor, criteria, sort)
+        query = Planet.query.options(*fields_load_plan(Planet, fields, planet_load_plan(), sort)).filter(*criteria)
+        if wants_stream():
+            return streamed_response(query.order_by(*order_clauses(Planet.id, sort)), partial(serialize_fields, fields=fields))
+        planets, next_cursor = paginate(query, Planet.id, limit, cursor, sort)
+        return paginated_response([serialize_fields(planet, fields) for planet in planets], next_cursor)
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/planets/<int:planet_id>', methods=['GET'])
+@query_budget(1)
+@cached_response('planet')
 def get_planet(planet_id):
+    fields = fields_param(field_names(Planet))
     try:
-        planet = Planet.query.filter_by(id=planet_id).first()
-        return jsonify(planet.serialize())
+        return jsonify(serialize_entity(Planet, planet_id, planet_load_plan(), fields))
     except:
         return {'error': 'Something went wrong...'}
 
@@ -174,61 +253,55 @@ def get_planet(planet_id):
 
 @app.route('/vehicles/create', methods=['POST'])
 def crete_vehicle():
-    # speeder_bike_dict = {
-    #     "name": "Speeder Bike",
-    #     "url": "https://swapi.co/api/vehicles/1/",
-    #     "model": "74-Z",
-    #     "vehicle_class": "Speeder",
-    #     "manufacturer": "Aratech Repulsor Company",
-    #     "cost_in_credits": "8000",
-    #     "length_in_m": "3.2",
-    #     "crew": "1",
-    #     "passengers": "1",
-    #     "max_atmosphering_speed_in_kmh": "360",
-    #     "cargo_capacity_in_kg": "4"
-    # }
-    # millennium_falcon_dict = {
-    #     "name": "Millennium Falcon",
-    #     "url": "https://swapi.co/api/vehicles/10/",
-    #     "model": "YT-1300 light freighter",
-    #     "vehicle_class": "light freighter",
-    #     "manufacturer": "Corellian Engineering Corporation",
-    #     "cost_in_credits": "100000",
-    #     "length_in_m": "34.37",
-    #     "crew": "4",
-    #     "passengers": "6",
-    #     "max_atmosphering_speed_in_kmh": "1050",
-    #     "cargo_capacity_in_kg": "100000"
-    # }
-    # vehicles_list = [speeder_bike_dict, millennium_falcon_dict]
-    # vehicles = [Vehicle(**vehicle) for vehicle in vehicles_list]
-    # db.session.add_all(vehicles)
-    # db.session.commit()
-    return {"msg": "create vehicle"}
+    rows = request_rows()
+    try:
+        return jsonify(bulk_upsert(Vehicle, rows, app.config['INGEST_CHUNK_SIZE']))
+    except:
+        db.session.rollback()
+        return {'error': 'Something went wrong...'}
+    finally:
+        db.session.close()
 
 @app.route('/vehicles', methods=['GET'])
+@query_budget(2)
+@cached_response('vehicle', 'character_x_vehicle', 'character')
 def get_vehicles():
+    sort = sort_param(Vehicle)
+    criteria = filter_params(Vehicle)
+    limit, cursor = page_params(sort)
+    fields = fields_param(field_names(Vehicle))
     try:
-        vehicles = []
-        for vehicle in Vehicle.query.all():
-            vehicles.append(vehicle.serialize())
-        return jsonify(vehicles)
+        if fast_serializer.enabled():
+            if wants_stream():
+                return fast_serializer.streamed_response(Vehicle, fields, wants_ndjson(), criteria, sort)
+            return fast_serializer.page_response(Vehicle, fields, limit, cursor, criteria, sort)
+        query = Vehicle.query.options(*fields_load_plan(Vehicle, fields, vehicle_load_plan(), sort)).filter(*criteria)
+        if wants_stream():
+            return streamed_response(query.order_by(*order_clauses(Vehicle.id, sort)), partial(serialize_fields, fields=fields))
+        vehicles, next_cursor = paginate(query, Vehicle.id, limit, cursor, sort)
+        return paginated_response([serialize_fields(vehicle, fields) for vehicle in vehicles], next_cursor)
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/vehicles/<int:vehicle_id>', methods=['GET'])
+@query_budget(2)
+@cached_response('vehicle', 'character_x_vehicle', 'character')
 def get_vehicle(vehicle_id):
+    fields = fields_param(field_names(Vehicle))
     try:
-        vehicle = Vehicle.query.filter_by(id=vehicle_id).first()
-        return jsonify(vehicle.serialize())
+        return jsonify(serialize_entity(Vehicle, vehicle_id, vehicle_load_plan(), fields))
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/vehicles/<int:vehicle_id>/characters', methods=['GET'])
+@query_budget(4)
+@cached_response('vehicle', 'character_x_vehicle', 'character')
 def get_vehicle_characters(vehicle_id):
+    fields = fields_param(field_names(Character))
     try:
-        vehicle = Vehicle.query.get(vehicle_id)
-        characters = [c.character.serialize() for c in vehicle.characters]
+        serialize_entity(Vehicle, vehicle_id, vehicle_load_plan(), ['id'])
+        links = Character_X_Vehicle.query.filter_by(vehicle_id=vehicle_id).order_by(Character_X_Vehicle.id)
+        characters = serialize_entities(Character, [c.character_id for c in links], character_load_plan(), fields)
         return jsonify(characters)
     except:
         return {'error': 'Something went wrong...'}
@@ -237,29 +310,48 @@ def get_vehicle_characters(vehicle_id):
 # ---------------------------------------------------------
 
 @app.route('/users/<int:user_id>/favorites', methods=['GET'])
+@query_budget(10)
 def get_user_favorites(user_id):
+    fields = fields_param(field_names(Favorite))
+    expand = wants_expanded('favorites') and (fields is None or 'favorite' in fields)
     try:
         user = User.query.get(user_id)
-        return jsonify([f.serialize() for f in user.favorites])
+        favorites = Favorite.query.options(*fields_load_plan(Favorite, fields, favorite_load_plan()))
+        favorites = [serialize_fields(f, fields) for f in favorites.filter_by(user_id=user.id).order_by(Favorite.id)]
+        if expand:
+            favorites = expand_favorites(favorites)
+        return jsonify(favorites)
     except:
         return {'error': 'Something went wrong...'}
 
 @app.route('/users/<int:user_id>/favorites/<group>/<int:obj_id>/add', methods=['POST'])
+@query_budget(5)
 def add_favorite(user_id, group, obj_id):
+    if group not in FAVORITE_TARGETS:
+        raise APIException(f'Unknown favorite group {group}')
     try:
-        new_fav = Favorite(user_id=user_id)
-        if group == 'characters':
-            element = Character.query.get(obj_id)
-            new_fav.character_id = obj_id
-        elif group == 'planets':
-            element = Planet.query.get(obj_id)
-            new_fav.planet_id = obj_id
-        elif group == 'vehicles':
-            element = Vehicle.query.get(obj_id)
-            new_fav.vehicle_id = obj_id
-        db.session.add(new_fav)
-        db.session.commit()
-        return {'msg': f'favorite {group} added'}
+        result = write_favorites(user_id, [('add', {'type': group, 'id': obj_id})])
+        if result is None:
+            return jsonify({'message': 'User not found'}), 404
+        if result[0]['status'] == 'not_found':
+            return jsonify({'message': f'{group[:-1].capitalize()} not found'}), 404
+        return {'msg': f'favorite {group} added', 'id': result[0]['favorite_id']}
+    except:
+        db.session.rollback()
+        return {'error': 'Something went wrong...'}
+    finally:
+        db.session.close()
+
+# {"add": [{"type": "characters", "id": 1}, ...], "remove": [...]}, see favorites.py
+@app.route('/users/<int:user_id>/favorites/batch', methods=['POST'])
+@query_budget(8)
+def batch_favorites(user_id):
+    items = favorite_batch_params(app.config['FAVORITES_BATCH_SIZE'])
+    try:
+        results = write_favorites(user_id, items)
+        if results is None:
+            return jsonify({'message': 'User not found'}), 404
+        return jsonify(results)
     except:
         db.session.rollback()
         return {'error': 'Something went wrong...'}
@@ -267,15 +359,17 @@ def add_favorite(user_id, group, obj_id):
         db.session.close()
 
 @app.route('/users/<int:user_id>/favorites/<int:fav_id>/delete', methods=['DELETE'])
+@query_budget(3)
 def delete_favorite_planet(user_id, fav_id):
     try:
-        fav_to_delete = Favorite.query.get(fav_id)
-        if fav_to_delete.user_id == user_id:
-            db.session.delete(fav_to_delete)
-            db.session.commit()
-            return {'msg': 'favorite was deleted'}
-        else:
+        result = write_favorites(user_id, [('delete', fav_id)])
+        if result is None:
+            return jsonify({'message': 'User not found'}), 404
+        if result[0]['status'] == 'absent':
+            return jsonify({'message': 'Favorite not found'}), 404
+        if result[0]['status'] == 'wrong_user':
             return {'error': 'wrong user'}
+        return {'msg': 'favorite was deleted'}
     except:
         db.session.rollback()
         return {'error': 'Something went wrong...'}
@@ -283,6 +377,79 @@ def delete_favorite_planet(user_id, fav_id):
         db.session.close()
 
 
+# Search
+# -------------------------------------------------------
+
+@app.route('/search', methods=['GET'])
+@query_budget(5)
+@cached_response('character', 'planet', 'vehicle')
+def search():
+    terms, kinds = search_params()
+    limit, _ = page_params()
+    try:
+        return jsonify(find(terms, kinds, limit))
+    except:
+        return {'error': 'Something went wrong...'}
+
+
+# Delta sync
+# -------------------------------------------------------
+
+# what changed in the catalog and the favorites after ?since=, see changes.py
+@app.route('/changes', methods=['GET'])
+@query_budget(11)
+def get_changes():
+    cursor, kinds, user_id = changes_params()
+    limit, _ = page_params()
+    try:
+        if cursor is None:
+            return jsonify({'changes': [], 'cursor': encode_cursor(head()), 'has_more': False})
+        changes, next_cursor, has_more = read_changes(cursor, kinds, user_id, limit)
+        return jsonify({'changes': changes, 'cursor': encode_cursor(next_cursor), 'has_more': has_more})
+    except:
+        return {'error': 'Something went wrong...'}
+
+
+# Catalog snapshots
+# -------------------------------------------------------
+
+@app.route('/snapshots', methods=['GET'])
+@query_budget(1)
+def get_snapshots():
+    return jsonify(snapshot_manifest())
+
+# e.g. /snapshots/characters.ndjson, gzip or brotli encoded when accepted
+@app.route('/snapshots/<name>', methods=['GET'])
+@query_budget(1)
+def get_snapshot(name):
+    return snapshot_response(name)
+
+@app.route('/snapshots/<version>/<name>', methods=['GET'])
+@query_budget(1)
+def get_snapshot_version(version, name):
+    return snapshot_response(name, version)
+
+
+# Cache, connection pool and metrics
+# -------------------------------------------------------
+
+@app.route('/cache/stats', methods=['GET'])
+@ops_only
+def get_cache_stats():
+    return jsonify(entity_cache.stats())
+
+@app.route('/pool/stats', methods=['GET'])
+@ops_only
+def get_pool_stats():
+    return jsonify(pool_stats(db.engine))
+
+# Prometheus text format
+@app.route('/metrics', methods=['GET'])
+@ops_only
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 # Sitemap
 # -------------------------------------------------------
 # generate sitemap with all your endpoints
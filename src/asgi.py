@@ -0,0 +1,66 @@
+"""
+ASGI entry point for the read-only routes, next to the gunicorn (WSGI) app:
+
+    $ uvicorn asgi:application --app-dir src --workers 2
+
+It answers GET/HEAD on the catalog, users/favorites and search routes with
+the very same Flask views, so the responses (and the caches behind them) are
+identical. Writes and the admin are not served here, they stay on the WSGI
+app: a write gets a 405, any other route a 404.
+
+This is a thread-pool bridge, not an async app: SQLAlchemy 1.3 has no
+asyncio support, so queries can't be awaited and the database access still
+blocks. The Flask app runs behind a2wsgi's WSGIMiddleware (the adapter
+uvicorn recommends for WSGI apps) on ASGI_THREADS threads, by default one per
+pooled connection. That serves about as many requests as the gthread
+workers of gunicorn.conf.py (benchmarks/asgi_load.py); the point is to put
+the read routes behind an ASGI server, not more throughput.
+"""
+import json
+import os
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import NotFound, MethodNotAllowed
+from app import app
+
+READ_ENDPOINTS = {
+    'get_uses', 'get_user', 'get_user_favorites',
+    'get_characters', 'get_character', 'get_character_vehicles',
+    'get_planets', 'get_planet',
+    'get_vehicles', 'get_vehicle', 'get_vehicle_characters',
+    'search'
+}
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _error(status, message, headers=()):
+    return app.response_class(json.dumps({'message': message}), status, headers, mimetype='application/json')
+
+def read_only(wsgi_app, endpoints):
+    # WSGI middleware passing on the read requests to the endpoints, matched
+    # with the request's own method
+    def read_only_app(environ, start_response):
+        urls = app.url_map.bind_to_environ(environ)
+        method = environ['REQUEST_METHOD']
+        try:
+            endpoint, _ = urls.match(method='GET')
+        except (NotFound, MethodNotAllowed):
+            endpoint = None
+        if endpoint in endpoints:
+            if method in READ_METHODS:
+                return wsgi_app(environ, start_response)
+            response = _error(405, 'Read-only, send writes to the main app', {'Allow': 'GET, HEAD'})
+        else:
+            try:
+                urls.match(method=method)
+                response = (_error(404, 'Not served by the read-only app') if method in READ_METHODS
+                            else _error(405, 'Read-only, send writes to the main app', {'Allow': ''}))
+            except NotFound:
+                response = _error(404, 'Not Found')
+            except MethodNotAllowed:
+                response = _error(405, 'Method Not Allowed', {'Allow': ''})
+        return response(environ, start_response)
+    return read_only_app
+
+
+threads = int(os.getenv('ASGI_THREADS', app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW']))
+application = WSGIMiddleware(read_only(app, READ_ENDPOINTS), workers=threads)
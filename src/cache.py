@@ -0,0 +1,340 @@
+"""
+In-process caches for the read routes. The rendered catalog responses and
+the serialized entities are kept here and dropped as soon as a commit touches
+the rows they were built from, whether the write came from the API or from
+Flask-Admin.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, make_response, Response
+from utils import wants_stream
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper, Session
+from sqlalchemy.inspection import inspect
+
+
+class CachedResponse:
+    def __init__(self, body, mimetype, headers, built_at):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # the time the body was read from the database: every change it
+        # includes is older, whichever worker process made it
+        self.last_modified = built_at
+
+
+class ResponseCache:
+    # Rendered responses keyed by request path, bounded by LRU and TTL. As in
+    # EntityCache, the TTL is for the writes of other worker processes; a
+    # commit in this process drops the entries built from its tables.
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, entry = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                del self._tables[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, tables, generation):
+        with self._lock:
+            # a commit landed while the body was being built, it may be stale
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            self._tables[key] = tables
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                del self._tables[old_key]
+
+    def invalidate(self, tables):
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, deps in self._tables.items() if deps & tables]
+            for key in stale:
+                del self._entries[key]
+                del self._tables[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+
+
+response_cache = ResponseCache()
+
+
+class EntityCache:
+    # Serialized entities keyed by (table, id), bounded by LRU and TTL. The TTL
+    # only matters for writes made by other worker processes; writes in this
+    # process evict the entry, and everything that embedded it, on commit.
+
+    def __init__(self, max_entries=4096, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, depends_on=(), generation=None):
+        # depends_on lists the keys of every row whose data is embedded in value
+        # (a character's vehicle names, a user's favorites, ...): evicting one of
+        # them evicts value too. It is not followed transitively, so nested data
+        # must list its own dependencies as well.
+        depends_on = frozenset(depends_on)
+        with self._lock:
+            # a commit landed since the rows were read, value may be stale
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, depends_on)
+            for dep in depends_on:
+                self._dependents.setdefault(dep, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            stale = set(keys)
+            for key in list(stale):
+                stale.update(self._dependents.pop(key, ()))
+            for key in stale:
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def invalidate_table(self, table):
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == table]
+            keys += [key for key in self._dependents if key[0] == table]
+        self.invalidate(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+    def _remove(self, key):
+        _, _, depends_on = self._entries.pop(key)
+        for dep in depends_on:
+            dependents = self._dependents.get(dep)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[dep]
+
+
+entity_cache = EntityCache()
+
+
+def cached_serialize(serialize):
+    # Wraps a model's serialize(); the model may define cache_dependencies()
+    # returning the (table, id) keys of the rows its output embeds. The value
+    # is only cached if nothing was invalidated since the object was loaded
+    # (see _stamp_generation), or else since serialize() started.
+    def fill(self):
+        # serializes and caches, without the lookup: for callers that already
+        # missed (models.serialize_entity), so the miss is counted once
+        generation = self.__dict__.get('_cache_generation', entity_cache.generation)
+        data = serialize(self)
+        dependencies = getattr(self, 'cache_dependencies', None)
+        entity_cache.put((self.__tablename__, self.id), data, dependencies() if dependencies else (), generation)
+        return data
+
+    @wraps(serialize)
+    def wrapper(self):
+        data = entity_cache.get((self.__tablename__, self.id))
+        return data if data is not None else fill(self)
+    wrapper.fill = fill
+    return wrapper
+
+
+def _host_root():
+    # scheme and host of the request, e.g. https://api.example.com
+    return request.host_url.rstrip('/')
+
+def cached_response(*tables):
+    # Caches the body of a successful (Response-returning) view under the
+    # request path, and answers with ETag/Last-Modified so clients can
+    # revalidate. A matching If-None-Match is answered with 304 straight from
+    # the cache, without touching the database or serializing anything.
+    # Streamed (?stream=true or Accept: application/x-ndjson) requests skip
+    # it: the key is only the path, and streams can't be replayed anyway.
+    tables = frozenset(tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if wants_stream():
+                response = make_response(view(*args, **kwargs))
+                response.vary.add('Accept')
+                return response
+            key = request.full_path
+            entry = response_cache.get(key)
+            if entry is None:
+                generation = response_cache.generation
+                built_at = datetime.now(timezone.utc).replace(microsecond=0)
+                rv = view(*args, **kwargs)
+                # errors come back as plain dicts and streams can't be replayed
+                if not isinstance(rv, Response) or rv.is_streamed or rv.status_code != 200:
+                    return rv
+                # the next-page Link is absolute, on the host of this request:
+                # it is cached without the host and completed for each client
+                headers = {}
+                if 'Link' in rv.headers:
+                    headers['Link'] = rv.headers['Link'].replace(f'<{_host_root()}', '<', 1)
+                entry = CachedResponse(rv.get_data(), rv.mimetype, headers, built_at)
+                response_cache.put(key, entry, tables, generation)
+            response = make_response(entry.body)
+            response.mimetype = entry.mimetype
+            response.headers.update(entry.headers)
+            if 'Link' in entry.headers:
+                response.headers['Link'] = entry.headers['Link'].replace('<', f'<{_host_root()}', 1)
+            response.set_etag(entry.etag)
+            response.last_modified = entry.last_modified
+            response.cache_control.no_cache = True
+            response.vary.add('Accept')
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+# Invalidation
+# ------------------------------------------------------------
+# The tables and rows written in a transaction are collected at flush time
+# and the cached data built from them is dropped once the commit succeeds.
+# Besides the row itself, every row its foreign keys point at (before and
+# after the change) is evicted: a new Character_X_Vehicle changes both the
+# character's and the vehicle's serialization, a Favorite changes its user's.
+
+def _row_key(obj, state):
+    return (obj.__tablename__, state.identity[0] if state.identity else obj.id)
+
+def _entity_keys(obj, state):
+    yield _row_key(obj, state)
+    for prop in state.mapper.column_attrs:
+        for fk in prop.columns[0].foreign_keys:
+            for value in state.attrs[prop.key].history.sum():
+                if value is not None:
+                    yield (fk.column.table.name, value)
+
+def _collect_changes(session, flush_context):
+    tables = session.info.setdefault('changed_tables', set())
+    rows = session.info.setdefault('changed_rows', set())
+    entities = session.info.setdefault('changed_entities', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table is not None:
+            state = inspect(obj)
+            tables.add(table)
+            rows.add(_row_key(obj, state))
+            entities.update(_entity_keys(obj, state))
+
+def _stamp_generation(target, context, attrs=None):
+    # on load and refresh: the entity cache generation the row was read at
+    target.__dict__['_cache_generation'] = entity_cache.generation
+
+def _invalidate_changes(session):
+    tables = session.info.pop('changed_tables', None)
+    rows = session.info.pop('changed_rows', None)
+    entities = session.info.pop('changed_entities', None)
+    if tables:
+        response_cache.invalidate(frozenset(tables))
+    if entities:
+        entity_cache.invalidate(entities)
+    if tables:
+        for listener in commit_listeners:
+            listener(tables, rows)
+
+def _discard_changes(session):
+    session.info.pop('changed_tables', None)
+    session.info.pop('changed_rows', None)
+    session.info.pop('changed_entities', None)
+
+
+# Other in-process state built from the tables (the search index, the
+# replica routing, the snapshots) adds a callback to these lists instead of
+# listening to the session itself:
+#   - commit_listeners are called after each commit with the tables it wrote
+#     and the (table, id) of its rows
+#   - bulk_write_listeners with the tables that invalidate_tables() reports,
+#     for writes that bypass the session events
+commit_listeners = []
+bulk_write_listeners = []
+
+def invalidate_tables(tables):
+    # for writes that bypass the session events (bulk mappings, Core statements)
+    response_cache.invalidate(frozenset(tables))
+    for table in tables:
+        entity_cache.invalidate_table(table)
+    for listener in bulk_write_listeners:
+        listener(tables)
+
+
+def setup_cache(app):
+    response_cache.max_entries = app.config.get('RESPONSE_CACHE_SIZE', 1024)
+    response_cache.ttl = app.config.get('RESPONSE_CACHE_TTL', 60)
+    entity_cache.max_entries = app.config.get('ENTITY_CACHE_SIZE', 4096)
+    entity_cache.ttl = app.config.get('ENTITY_CACHE_TTL', 300)
+    if not event.contains(Session, 'after_flush', _collect_changes):
+        event.listen(Session, 'after_flush', _collect_changes)
+        event.listen(Session, 'after_commit', _invalidate_changes)
+        event.listen(Session, 'after_rollback', _discard_changes)
+        event.listen(Mapper, 'load', _stamp_generation)
+        event.listen(Mapper, 'refresh', _stamp_generation)
@@ -0,0 +1,241 @@
+"""
+Delta sync for clients that keep a copy of the catalog and of favorites:
+/changes?since=<cursor> returns the rows inserted, updated or deleted after
+the cursor, oldest first and in pages. A resync downloads the churn since the
+last one instead of whole collections.
+
+    GET /changes
+    {"changes": [], "cursor": "WzAsMTJd", "has_more": false}
+
+    GET /changes?since=WzAsMTJd&type=planet,favorite&user_id=1
+    {"changes": [{"type": "planet", "id": 3, "op": "update", "data": {...}},
+                 {"type": "favorite", "id": 7, "op": "delete"}],
+     "cursor": "WzAsMTVd", "has_more": false}
+
+Without since there are no changes, only the current cursor: take it before
+fetching the collections, then poll from it (a change may be seen twice, but
+never missed). Within a page each row appears once, with its current state
+as its GET route serializes it; deletes are tombstones, without data.
+
+The changes come from change_log (models.ChangeLog), written by triggers on
+the tables, so every write path is logged: ORM, bulk upserts and the Core
+statements of favorites.py. Renaming a row also logs the rows that embed its
+name (its favorites, the vehicles of a character...). The triggers are
+created by their migration, and by create_all().
+
+A change is versioned by (txid, id). On Postgres, concurrent transactions
+commit out of id order, so only the changes of transactions older than every
+one still running are returned: the cursor never moves past a change that
+is not visible yet. `flask prune-changes` drops the old changes; a cursor
+from before what is left gets a 410, and the client starts over.
+"""
+from flask import request
+from sqlalchemy import event, func, or_, tuple_
+from models import db, ChangeLog, Character, Planet, Vehicle, Favorite
+from models import character_load_plan, planet_load_plan, vehicle_load_plan, favorite_load_plan
+from utils import APIException, decode_cursor
+
+# type (the table) -> model and load plan
+TYPES = {
+    'character': (Character, character_load_plan),
+    'planet': (Planet, planet_load_plan),
+    'vehicle': (Vehicle, vehicle_load_plan),
+    'favorite': (Favorite, favorite_load_plan),
+}
+
+
+def changes_params():
+    # ?since=<cursor>&type=character,favorite&user_id=1 -> (cursor or None, types, user id or None)
+    kinds = [kind for kind in request.args.get('type', '').split(',') if kind]
+    unknown = [kind for kind in kinds if kind not in TYPES]
+    if unknown:
+        raise APIException(f"Unknown types: {', '.join(unknown)}")
+    user_id = request.args.get('user_id')
+    if user_id is not None:
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            raise APIException('user_id must be an integer')
+    cursor = None
+    if request.args.get('since'):
+        cursor = decode_cursor(request.args['since'])
+        if len(cursor) != 2 or not all(isinstance(value, int) for value in cursor):
+            raise APIException('Invalid cursor')
+        # prune() leaves its marker as the first change
+        first = db.session.query(ChangeLog.txid, ChangeLog.id, ChangeLog.op).order_by(ChangeLog.txid, ChangeLog.id).first()
+        if first is not None and first.op == 'pruned' and tuple(cursor) < (first.txid, first.id):
+            raise APIException('Cursor expired, fetch the collections again', status_code=410)
+    return cursor, kinds or list(TYPES), user_id
+
+
+def _postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def head():
+    # the cursor of "now": every change after it is still to come
+    if _postgres():
+        return [db.session.query(func.txid_snapshot_xmin(func.txid_current_snapshot())).scalar(), 0]
+    return [0, db.session.query(func.max(ChangeLog.id)).scalar() or 0]
+
+
+def _serialize(obj):
+    # from the row itself: the entity cache of this process may not have seen
+    # a write made by another one yet, and the cursor would move past it
+    serialize = type(obj).serialize
+    return getattr(serialize, '__wrapped__', serialize)(obj)
+
+def read_changes(cursor, kinds, user_id, limit):
+    # ([change], next cursor, has more)
+    query = db.session.query(ChangeLog.txid, ChangeLog.id, ChangeLog.table_name, ChangeLog.row_id, ChangeLog.op)
+    query = query.filter(tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(*cursor))
+    if _postgres():
+        query = query.filter(ChangeLog.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    if set(kinds) != set(TYPES):
+        query = query.filter(ChangeLog.table_name.in_(kinds))
+    if user_id is not None:
+        query = query.filter(or_(ChangeLog.table_name != 'favorite', ChangeLog.user_id == user_id))
+    rows = query.order_by(ChangeLog.txid, ChangeLog.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = [rows[-1].txid, rows[-1].id] if rows else cursor
+
+    # the last change of each row, in the order of those; an insert followed
+    # by updates is still an insert for the client
+    latest = {}
+    for row in rows:
+        key = (row.table_name, row.row_id)
+        op = 'insert' if row.op == 'update' and latest.get(key) == 'insert' else row.op
+        latest.pop(key, None)
+        latest[key] = op
+
+    # the current rows, one query per type (and its load plan)
+    ids = {}
+    for (table, row_id), op in latest.items():
+        if op != 'delete':
+            ids.setdefault(table, []).append(row_id)
+    data = {}
+    for table, row_ids in ids.items():
+        model, load_plan = TYPES[table]
+        for obj in model.query.options(*load_plan()).filter(model.id.in_(row_ids)):
+            data[(table, obj.id)] = _serialize(obj)
+
+    changes = []
+    for key, op in latest.items():
+        change = {'type': key[0], 'id': key[1], 'op': op}
+        if key in data and op != 'delete':
+            change['data'] = data[key]
+        else:
+            # deleted since; its own delete comes in a later page
+            change['op'] = 'delete'
+        changes.append(change)
+    return changes, next_cursor, has_more
+
+
+def prune(before):
+    # Drops the changes made before `before` (UTC). The newest of them stays,
+    # marked 'pruned': the log starts there, older cursors get a 410.
+    marker = (ChangeLog.query.filter(ChangeLog.changed_at < before)
+              .order_by(ChangeLog.txid.desc(), ChangeLog.id.desc()).first())
+    if marker is None:
+        return 0
+    deleted = (ChangeLog.query.filter(tuple_(ChangeLog.txid, ChangeLog.id) < tuple_(marker.txid, marker.id))
+               .delete(synchronize_session=False))
+    marker.op = 'pruned'
+    db.session.commit()
+    return deleted
+
+
+# Triggers
+# ------------------------------------------------------------
+# Keep in sync with the change_log migration.
+
+# table -> the rows that embed its name: (their table, id, user id, from, where column)
+EMBEDDED = {
+    'planet': [('favorite', 'id', 'user_id', 'favorite', 'planet_id')],
+    'vehicle': [('favorite', 'id', 'user_id', 'favorite', 'vehicle_id'),
+                ('character', 'character_id', 'NULL', 'character_x_vehicle', 'vehicle_id')],
+    'character': [('favorite', 'id', 'user_id', 'favorite', 'character_id'),
+                  ('vehicle', 'vehicle_id', 'NULL', 'character_x_vehicle', 'character_id')],
+    'favorite': [],
+}
+# a vehicle link changes both its character and its vehicle
+LINKS = {'character_x_vehicle': ['character', 'vehicle']}
+
+
+def _log(dialect, values, source=''):
+    if dialect == 'postgresql':
+        return (f"INSERT INTO change_log (txid, table_name, row_id, op, user_id) "
+                f"SELECT txid_current(), {values}{source};")
+    return f"INSERT INTO change_log (table_name, row_id, op, user_id) SELECT {values}{source};"
+
+def _row_log(dialect, table, row, op=None):
+    # op None is the operation of the Postgres trigger
+    user_id = f'{row}.user_id' if table == 'favorite' else 'NULL'
+    op = f"'{op}'" if op else 'lower(TG_OP)'
+    return _log(dialect, f"'{table}', {row}.id, {op}, {user_id}")
+
+def _embedded_logs(dialect, table, row, condition=''):
+    return ' '.join(_log(dialect, f"'{target}', {id_column}, 'update', {user_id}",
+                         f" FROM {source} WHERE {column} = {row}.id{condition}")
+                    for target, id_column, user_id, source, column in EMBEDDED[table])
+
+def _link_logs(dialect, table, row):
+    return ' '.join(_log(dialect, f"'{target}', {row}.{target}_id, 'update', NULL") for target in LINKS[table])
+
+
+def trigger_statements(dialect, columns):
+    # columns is table -> its column names; SQLite only logs the updates
+    # that change one of them
+    statements = []
+    if dialect == 'postgresql':
+        for table in EMBEDDED:
+            embedded = ''
+            if EMBEDDED[table]:
+                # nested: OLD is not assigned in an INSERT trigger
+                embedded = (f"IF TG_OP = 'UPDATE' THEN IF OLD.name IS DISTINCT FROM NEW.name THEN "
+                            f"{_embedded_logs(dialect, table, 'NEW')} END IF; END IF; ")
+            statements.append(
+                f"CREATE OR REPLACE FUNCTION change_log_{table}() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP = 'DELETE' THEN {_row_log(dialect, table, 'OLD', 'delete')} "
+                f"ELSE {_row_log(dialect, table, 'NEW')} END IF; "
+                f"{embedded}RETURN NULL; END $$ LANGUAGE plpgsql")
+            statements.append(f'CREATE TRIGGER change_log_{table} AFTER INSERT OR DELETE ON "{table}" '
+                              f'FOR EACH ROW EXECUTE PROCEDURE change_log_{table}()')
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" '
+                              f'FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE change_log_{table}()')
+        for table in LINKS:
+            statements.append(
+                f"CREATE OR REPLACE FUNCTION change_log_{table}() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP <> 'INSERT' THEN {_link_logs(dialect, table, 'OLD')} END IF; "
+                f"IF TG_OP <> 'DELETE' THEN {_link_logs(dialect, table, 'NEW')} END IF; "
+                f"RETURN NULL; END $$ LANGUAGE plpgsql")
+            statements.append(f'CREATE TRIGGER change_log_{table} AFTER INSERT OR UPDATE OR DELETE ON "{table}" '
+                              f'FOR EACH ROW EXECUTE PROCEDURE change_log_{table}()')
+    elif dialect == 'sqlite':
+        for table in EMBEDDED:
+            changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in columns[table])
+            embedded = _embedded_logs(dialect, table, 'new', ' AND old.name IS NOT new.name') if EMBEDDED[table] else ''
+            statements.append(f'CREATE TRIGGER change_log_{table}_insert AFTER INSERT ON "{table}" '
+                              f"BEGIN {_row_log(dialect, table, 'new', 'insert')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" WHEN {changed} '
+                              f"BEGIN {_row_log(dialect, table, 'new', 'update')} {embedded} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_delete AFTER DELETE ON "{table}" '
+                              f"BEGIN {_row_log(dialect, table, 'old', 'delete')} END")
+        for table in LINKS:
+            statements.append(f'CREATE TRIGGER change_log_{table}_insert AFTER INSERT ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'new')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_update AFTER UPDATE ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'old')} {_link_logs(dialect, table, 'new')} END")
+            statements.append(f'CREATE TRIGGER change_log_{table}_delete AFTER DELETE ON "{table}" '
+                              f"BEGIN {_link_logs(dialect, table, 'old')} END")
+    return statements
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_triggers(metadata, connection, tables=(), **kw):
+    # create_all(): once change_log exists, all the tables it tracks do too
+    if 'change_log' not in {table.name for table in tables}:
+        return
+    columns = {table: [column.name for column in metadata.tables[table].columns] for table in EMBEDDED}
+    for statement in trigger_statements(connection.dialect.name, columns):
+        connection.execute(statement)
@@ -0,0 +1,156 @@
+"""
+Flask CLI commands, registered on the app by setup_commands(app):
+
+    $ flask import-swapi swapi.json
+    $ flask prune-changes --days 30
+    $ flask build-snapshots
+"""
+import json
+import re
+from datetime import datetime, timedelta
+import click
+from models import db, Planet, Vehicle, Character, Character_X_Vehicle
+from ingest import bulk_upsert
+from cache import invalidate_tables
+from changes import prune as prune_changes
+from snapshots import snapshots
+
+
+# SWAPI field -> our column, per resource
+PLANET_FIELDS = {
+    "name": "name",
+    "url": "url",
+    "diameter": "diameter_in_km",
+    "rotation_period": "rotation_period_in_days",
+    "orbital_period": "orbital_period_in_days",
+    "gravity": "gravity_in_g",
+    "population": "population",
+    "climate": "climate",
+    "terrain": "terrain",
+    "surface_water": "surface_water_percent"
+}
+VEHICLE_FIELDS = {
+    "name": "name",
+    "url": "url",
+    "model": "model",
+    "vehicle_class": "vehicle_class",
+    "manufacturer": "manufacturer",
+    "cost_in_credits": "cost_in_credits",
+    "length": "length_in_m",
+    "crew": "crew",
+    "passengers": "passengers",
+    "max_atmosphering_speed": "max_atmosphering_speed_in_kmh",
+    "cargo_capacity": "cargo_capacity_in_kg"
+}
+CHARACTER_FIELDS = {
+    "name": "name",
+    "url": "url",
+    "height": "height_in_cm",
+    "mass": "mass_in_kg",
+    "hair_color": "hair_color",
+    "skin_color": "skin_color",
+    "eye_color": "eye_color",
+    "birth_year": "birthyear",
+    "gender": "gender"
+}
+
+NUMBER = re.compile(r'-?\d+(\.\d+)?')
+
+def _convert(model, record, fields):
+    # SWAPI sends numbers as strings ("1,358", "1 standard", "30-165") and
+    # uses "unknown"/"n/a" for missing values
+    row = {}
+    for swapi_key, column in fields.items():
+        value = record.get(swapi_key)
+        python_type = model.__table__.columns[column].type.python_type
+        if isinstance(value, str) and python_type in (int, float):
+            match = NUMBER.search(value.replace(',', ''))
+            value = match.group() if match else None
+            # a few SWAPI populations (Coruscant...) don't fit an Integer column
+            if value is not None and python_type is int and abs(float(value)) >= 2**31:
+                value = None
+        elif isinstance(value, str) and value.lower() in ('unknown', 'n/a', 'none'):
+            value = None
+        row[column] = value
+    return row
+
+def _url_index(model):
+    # one query per table instead of one per reference
+    return dict(db.session.query(model.url, model.id).filter(model.url.isnot(None)))
+
+def _report(label, result):
+    click.echo(f"{label}: {result['inserted']} inserted, {result['updated']} updated, {len(result['errors'])} errors")
+    for error in result['errors'][:10]:
+        click.echo(f"  row {error['row']}: {error['error']}")
+
+
+def import_swapi(data, chunk_size=1000):
+    planets = data.get('planets', [])
+    vehicles = data.get('vehicles', [])
+    people = data.get('people', data.get('characters', []))
+
+    _report('planets', bulk_upsert(Planet, (_convert(Planet, p, PLANET_FIELDS) for p in planets), chunk_size))
+    _report('vehicles', bulk_upsert(Vehicle, (_convert(Vehicle, v, VEHICLE_FIELDS) for v in vehicles), chunk_size))
+
+    planet_ids = _url_index(Planet)
+    characters = []
+    for person in people:
+        row = _convert(Character, person, CHARACTER_FIELDS)
+        row['planet_id'] = planet_ids.get(person.get('homeworld'))
+        characters.append(row)
+    _report('characters', bulk_upsert(Character, characters, chunk_size))
+
+    # Character_X_Vehicle: the links of every imported character are synced
+    # to the dump, only the differences are written
+    character_ids = _url_index(Character)
+    vehicle_ids = _url_index(Vehicle)
+    wanted = set()
+    imported = set()
+    for person in people:
+        character_id = character_ids.get(person.get('url'))
+        if character_id is None:
+            continue
+        imported.add(character_id)
+        for url in person.get('vehicles', []):
+            if url in vehicle_ids:
+                wanted.add((character_id, vehicle_ids[url]))
+    existing = {}
+    for link_id, character_id, vehicle_id in db.session.query(
+            Character_X_Vehicle.id, Character_X_Vehicle.character_id, Character_X_Vehicle.vehicle_id):
+        if character_id in imported:
+            existing[(character_id, vehicle_id)] = link_id
+    missing = [{'character_id': c, 'vehicle_id': v} for c, v in wanted - existing.keys()]
+    stale = [link_id for pair, link_id in existing.items() if pair not in wanted]
+    for i in range(0, len(missing), chunk_size):
+        db.session.bulk_insert_mappings(Character_X_Vehicle, missing[i:i + chunk_size])
+    for i in range(0, len(stale), chunk_size):
+        Character_X_Vehicle.query.filter(Character_X_Vehicle.id.in_(stale[i:i + chunk_size])).delete(synchronize_session=False)
+    db.session.commit()
+    invalidate_tables([Character_X_Vehicle.__tablename__, Character.__tablename__, Vehicle.__tablename__])
+    click.echo(f"vehicle links: {len(missing)} added, {len(stale)} removed")
+
+
+def setup_commands(app):
+
+    @app.cli.command('import-swapi')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--chunk-size', default=1000, show_default=True, help='Rows per bulk insert/commit.')
+    def import_swapi_command(path, chunk_size):
+        """Load a local SWAPI dump ({"planets": [...], "vehicles": [...], "people": [...]})."""
+        with open(path) as f:
+            data = json.load(f)
+        import_swapi(data, chunk_size)
+
+    @app.cli.command('prune-changes')
+    @click.option('--days', default=30, show_default=True, help='Days of changes to keep.')
+    def prune_changes_command(days):
+        """Drop the /changes log older than --days; clients with an older cursor get a 410 and resync."""
+        deleted = prune_changes(datetime.utcnow() - timedelta(days=days))
+        click.echo(f"{deleted} changes pruned")
+
+    @app.cli.command('build-snapshots')
+    def build_snapshots_command():
+        """Render the catalog snapshots served at /snapshots, unless the current ones are up to date."""
+        manifest = snapshots.build()
+        click.echo(f"snapshot {manifest['version']}: " + ', '.join(
+            f"{name} {info['rows']} rows" for name, info in manifest['files'].items() if name.endswith('.json')))
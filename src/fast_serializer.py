@@ -0,0 +1,179 @@
+"""
+Column-oriented serializer for the catalog list routes (SERIALIZER=fast).
+
+Instead of hydrating ORM objects and building a dict per instance, rows are
+read with Core selects and turned into JSON text directly, by an encoder
+generated once per (model, fieldset). The output is byte for byte what
+jsonify() produces for the serialize() dicts: same key order, separators,
+string escaping and float formatting.
+"""
+import json
+import math
+from json.encoder import encode_basestring_ascii, encode_basestring
+from flask import current_app, Response, stream_with_context
+from sqlalchemy import select
+from models import db, Character, Vehicle, Character_X_Vehicle, field_names
+from utils import encode_cursor, add_next_link, order_clauses, after_cursor, NDJSON
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# relationship-derived fields: the names of the rows on the other side of
+# Character_X_Vehicle, in link order
+RELATIONS = {
+    (Character, 'vehicles'): (Character_X_Vehicle.character_id, Character_X_Vehicle.vehicle_id, Vehicle),
+    (Vehicle, 'characters'): (Character_X_Vehicle.vehicle_id, Character_X_Vehicle.character_id, Character)
+}
+
+
+def enabled():
+    # the encoders only reproduce the compact output; debug mode pretty prints
+    provider = current_app.json
+    compact = provider.compact if provider.compact is not None else not current_app.debug
+    return current_app.config['SERIALIZER'] == 'fast' and compact
+
+
+# Value encoders
+# ------------------------------------------------------------
+
+def _string_encoder(ensure_ascii):
+    # orjson escapes exactly like json.dumps(ensure_ascii=False); with
+    # ensure_ascii the C escaper from the json module is already the fastest
+    if not ensure_ascii and orjson is not None:
+        dumps = orjson.dumps
+        return lambda value: 'null' if value is None else dumps(value).decode()
+    encode = encode_basestring_ascii if ensure_ascii else encode_basestring
+    return lambda value: 'null' if value is None else encode(value)
+
+def _number(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, float) and not math.isfinite(value):
+        return json.dumps(value)
+    return repr(value)
+
+def _list_encoder(encode_string):
+    return lambda values: '[' + ','.join(map(encode_string, values)) + ']'
+
+
+_encoders = {}
+
+def _compile(model, fields, ensure_ascii, sort_keys):
+    # Generates `def encode(row, related)` returning the JSON object for one
+    # row, e.g. '{"id":' + e0(row[0]) + ',"name":' + e1(row[1]) + '}'.
+    # row holds the selected columns (id first), related maps id -> names.
+    key = (model, fields, ensure_ascii, sort_keys)
+    if key in _encoders:
+        return _encoders[key]
+    encode_string = _string_encoder(ensure_ascii)
+    columns = _columns(model, fields)
+    namespace = {}
+    parts = []
+    for i, field in enumerate(sorted(fields) if sort_keys else fields):
+        prefix = ('{' if i == 0 else ',') + encode_string(field) + ':'
+        if field == 'id':
+            namespace[f'e{i}'] = _number
+            parts.append(f'{prefix!r} + e{i}(row[0])')
+        elif field in columns:
+            column = model.__table__.c[field]
+            namespace[f'e{i}'] = _number if column.type.python_type in (int, float) else encode_string
+            parts.append(f'{prefix!r} + e{i}(row[{columns.index(field) + 1}])')
+        else:
+            namespace[f'e{i}'] = _list_encoder(encode_string)
+            parts.append(f'{prefix!r} + e{i}(related.get(({field!r}, row[0]), ()))')
+    source = 'def encode(row, related):\n    return ' + ' + '.join(parts) + " + '}'\n"
+    exec(source, namespace)
+    _encoders[key] = namespace['encode']
+    return namespace['encode']
+
+
+# Queries
+# ------------------------------------------------------------
+
+def _columns(model, fields):
+    # the selected columns after the leading id
+    return [f for f in fields if f in model.__table__.c and f != 'id']
+
+def _select(model, fields, criteria=(), sort=()):
+    # the ?sort= values follow the fields (labeled, so a column that is also a
+    # field isn't merged into one), they are only read for the next cursor
+    table = model.__table__
+    columns = [table.c.id] + [table.c[f] for f in _columns(model, fields)]
+    columns += [column.label(f'sort_{i}') for i, (column, _) in enumerate(sort)]
+    stmt = select(columns).order_by(*order_clauses(table.c.id, sort))
+    for criterion in criteria:
+        stmt = stmt.where(criterion)
+    return stmt
+
+def _related(model, fields, ids):
+    related = {}
+    for field in fields:
+        if (model, field) not in RELATIONS or not ids:
+            continue
+        own_key, other_key, other = RELATIONS[(model, field)]
+        stmt = (select([own_key, other.__table__.c.name])
+                .select_from(Character_X_Vehicle.__table__.join(other.__table__, other_key == other.__table__.c.id))
+                .where(own_key.in_(ids))
+                .order_by(Character_X_Vehicle.__table__.c.id))
+        for obj_id, name in db.session.execute(stmt):
+            related.setdefault((field, obj_id), []).append(name)
+    return related
+
+def _encoder(model, fields):
+    provider = current_app.json
+    return _compile(model, fields, provider.ensure_ascii, provider.sort_keys)
+
+
+# Responses
+# ------------------------------------------------------------
+
+def encode_rows(model, rows, fields):
+    encode = _encoder(model, fields)
+    related = _related(model, fields, [row[0] for row in rows])
+    return [encode(row, related) for row in rows]
+
+def page_response(model, fields, limit, cursor, criteria=(), sort=()):
+    fields = tuple(fields or field_names(model))
+    stmt = _select(model, fields, criteria, sort)
+    if cursor is not None:
+        stmt = stmt.where(after_cursor(model.__table__.c.id, sort, cursor))
+    rows = db.session.execute(stmt.limit(limit + 1)).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last[f'sort_{i}'] for i in range(len(sort))] + [last[0]])
+    body = '[' + ','.join(encode_rows(model, rows, fields)) + ']\n'
+    return add_next_link(current_app.response_class(body, mimetype='application/json'), next_cursor)
+
+def encoded_chunks(model, fields, criteria=(), sort=()):
+    # the encoded rows, STREAM_CHUNK_SIZE at a time, read from a server-side cursor
+    fields = tuple(fields or field_names(model))
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    stmt = _select(model, fields, criteria, sort)
+    result = db.session.execute(stmt.execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield encode_rows(model, rows, fields)
+
+def streamed_response(model, fields, ndjson, criteria=(), sort=()):
+
+    def generate():
+        first = True
+        if not ndjson:
+            yield '['
+        for encoded in encoded_chunks(model, fields, criteria, sort):
+            if ndjson:
+                yield '\n'.join(encoded) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(encoded)
+                first = False
+        if not ndjson:
+            yield ']\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON if ndjson else 'application/json')
@@ -0,0 +1,212 @@
+"""
+Favorite writes in batches: many adds and removes for one user in one
+transaction, with a single existence check per target type. Both operations
+are idempotent (adding a favorite the user already has, or removing one they
+don't have, is reported and not an error), so a client can safely retry a
+whole batch.
+
+    POST /users/1/favorites/batch
+    {"add": [{"type": "characters", "id": 1}, {"type": "planets", "id": 3}],
+     "remove": [{"type": "vehicles", "id": 4}]}
+
+With FAVORITES_GROUP_COMMIT on, the single add/delete routes and the batches
+are not committed by the request that sent them: they queue for a writer
+thread that applies everything queued within FAVORITES_COMMIT_WINDOW_MS in
+one transaction (see group_commit.py). The request still answers only once
+its writes are committed.
+"""
+from flask import request
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Character, Planet, Vehicle, Favorite
+from cache import invalidate_tables
+from utils import APIException
+from group_commit import GroupCommitWriter
+
+# the URL groups, and the favorite "type" values of GET .../favorites
+TARGETS = {'characters': Character, 'planets': Planet, 'vehicles': Vehicle}
+ALIASES = {'character': 'characters', 'planet': 'planets', 'vehicle': 'vehicles'}
+COLUMNS = {'characters': 'character_id', 'planets': 'planet_id', 'vehicles': 'vehicle_id'}
+
+# the group commit writer, when it is on, set by setup_favorites()
+writer = None
+
+
+def favorite_batch_params(max_items):
+    # [(op, entry)], adds first, then removes, as they are applied
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not set(data) <= {'add', 'remove'}:
+        raise APIException('Expected {"add": [...], "remove": [...]}')
+    items = []
+    for op in ('add', 'remove'):
+        entries = data.get(op, [])
+        if not isinstance(entries, list):
+            raise APIException(f'{op} must be a list')
+        items.extend((op, entry) for entry in entries)
+    if len(items) > max_items:
+        raise APIException(f'At most {max_items} favorites per batch')
+    return items
+
+
+def _target(entry):
+    if not isinstance(entry, dict):
+        return None
+    group = ALIASES.get(entry.get('type'), entry.get('type'))
+    obj_id = entry.get('id')
+    if group not in TARGETS or not isinstance(obj_id, int) or isinstance(obj_id, bool) or obj_id < 1:
+        return None
+    return group, obj_id
+
+
+def _favorite_rows(*criteria):
+    # (favorite id, (user id, group, target id)); group is None for a
+    # favorite without a target
+    columns = [getattr(Favorite, COLUMNS[group]) for group in TARGETS]
+    for fav_id, user_id, *values in db.session.query(Favorite.id, Favorite.user_id, *columns).filter(*criteria):
+        target = next(((group, value) for group, value in zip(TARGETS, values) if value is not None), (None, fav_id))
+        yield fav_id, (user_id,) + target
+
+def _favorite_ids(keys):
+    # (user id, group, target id) -> favorite id, for those of keys that exist
+    by_group = {}
+    for _, group, obj_id in keys:
+        by_group.setdefault(group, set()).add(obj_id)
+    if not by_group:
+        return {}
+    users = {user_id for user_id, _, _ in keys}
+    rows = _favorite_rows(Favorite.user_id.in_(users),
+                          or_(*[getattr(Favorite, COLUMNS[group]).in_(ids) for group, ids in by_group.items()]))
+    return {key: fav_id for fav_id, key in rows if key in keys}
+
+
+def _write(requests):
+    # requests is [(user id, [(op, entry)])], applied in order in one
+    # transaction; returns ([result per item], changed) for each, or None
+    # when there is no such user
+    users = {user_id for user_id, _ in requests}
+    known = {user_id for user_id, in db.session.query(User.id).filter(User.id.in_(users))}
+
+    # one IN query per type, for the targets being added
+    to_add = {}
+    keys, by_id = set(), {}
+    for user_id, items in requests:
+        if user_id not in known:
+            continue
+        for op, entry in items:
+            target = _target(entry) if op != 'delete' else None
+            if target is not None:
+                keys.add((user_id,) + target)
+                if op == 'add':
+                    to_add.setdefault(target[0], set()).add(target[1])
+            elif op == 'delete':
+                by_id[entry] = None
+    existing = set()
+    for group, ids in to_add.items():
+        model = TARGETS[group]
+        existing.update((group, obj_id) for obj_id, in db.session.query(model.id).filter(model.id.in_(ids)))
+    if by_id:
+        by_id.update(_favorite_rows(Favorite.id.in_(by_id)))
+
+    before = _favorite_ids(keys)
+    before.update((key, fav_id) for fav_id, key in by_id.items() if key is not None)
+    present = dict(before)
+    written = []
+    for user_id, items in requests:
+        if user_id not in known:
+            written.append(None)
+            continue
+        results = []
+        for op, entry in items:
+            if op == 'delete':
+                key = by_id.get(entry)
+                result = {'op': op, 'favorite_id': entry}
+                if key is None or key not in present:
+                    result['status'] = 'absent'
+                elif key[0] != user_id:
+                    result['status'] = 'wrong_user'
+                else:
+                    result['status'] = 'removed'
+                    del present[key]
+                results.append(result)
+                continue
+            target = _target(entry)
+            if target is None:
+                results.append({'op': op, 'entry': entry, 'status': 'invalid'})
+                continue
+            key = (user_id,) + target
+            result = {'op': op, 'type': target[0], 'id': target[1]}
+            if op == 'add':
+                if target not in existing:
+                    result['status'] = 'not_found'
+                elif key in present:
+                    result['status'] = 'exists'
+                else:
+                    result['status'] = 'added'
+                    present[key] = None
+            elif key in present:
+                result['status'] = 'removed'
+                del present[key]
+            else:
+                result['status'] = 'absent'
+            result['key'] = key
+            results.append(result)
+        written.append((results, any(r['status'] in ('added', 'removed') for r in results)))
+
+    inserts = [key for key in present if key not in before]
+    deletes = [fav_id for key, fav_id in before.items() if key not in present]
+    if deletes:
+        Favorite.query.filter(Favorite.id.in_(deletes)).delete(synchronize_session=False)
+    if inserts:
+        # a Core insert with every column in every row is one executemany
+        # (bulk mappings would group the rows by the columns they set)
+        db.session.execute(Favorite.__table__.insert(), [dict({column: None for column in COLUMNS.values()},
+                                                              user_id=user_id, **{COLUMNS[group]: obj_id})
+                                                         for user_id, group, obj_id in inserts])
+        # the ids of the new rows, for the response
+        before.update(_favorite_ids(set(inserts)))
+    db.session.commit()
+
+    for item in written:
+        for result in item[0] if item else ():
+            key = result.pop('key', None)
+            if result['status'] in ('added', 'exists', 'removed') and key is not None:
+                result['favorite_id'] = before.get(key)
+    return written
+
+
+def write_many(requests, attempts=3):
+    for attempt in range(attempts):
+        try:
+            return _write(requests)
+        except IntegrityError:
+            # a concurrent request added one of them first: read again, it
+            # is reported as existing this time
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+def write_favorites(user_id, items):
+    # [result per item], or None when there is no such user. items are
+    # (op, entry): ('add'|'remove', {"type": ..., "id": ...}) or
+    # ('delete', favorite id)
+    if writer is not None:
+        written = writer.submit((user_id, items))
+    else:
+        written = write_many([(user_id, items)])[0]
+    if written is None:
+        return None
+    results, changed = written
+    if changed:
+        # Core statements skip the session events the caches listen to
+        invalidate_tables(['favorite'])
+    return results
+
+
+def setup_favorites(app):
+    global writer
+    if app.config.get('FAVORITES_GROUP_COMMIT'):
+        writer = GroupCommitWriter(app, write_many, 'favorite',
+                                   window=app.config.get('FAVORITES_COMMIT_WINDOW_MS', 5) / 1000,
+                                   max_batch=app.config.get('FAVORITES_COMMIT_MAX_BATCH', 64),
+                                   timeout=app.config.get('FAVORITES_COMMIT_TIMEOUT', 10))
@@ -0,0 +1,89 @@
+"""
+Filtering and sorting for the catalog list routes:
+
+    /characters?gender=female&mass_in_kg[gt]=80&sort=-height_in_cm,name
+
+Every other query argument is a filter, `field=value` or `field[op]=value`,
+on one of the model's `filter_fields`. They are compiled to bound SQL
+criteria, so the database does the filtering, and combine with the keyset
+pagination (see utils.paginate) and the ?fields= projection.
+"""
+import math
+import re
+from sqlalchemy import func, or_
+from flask import request
+from utils import APIException
+
+# arguments that belong to pagination, projection, streaming...
+RESERVED = ('limit', 'cursor', 'fields', 'stream', 'sort', 'expand', 'depth')
+
+PARAM = re.compile(r'^(\w+)(?:\[(\w+)\])?$')
+
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    # "not female" includes the rows with no gender at all
+    'ne': lambda column, value: or_(column != value, column.is_(None)),
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'in': lambda column, value: column.in_(value),
+    'contains': lambda column, value: func.lower(column).contains(value.lower(), autoescape=True),
+    'null': lambda column, value: column.is_(None) if value else column.isnot(None)
+}
+
+
+def _coerce(column, raw):
+    python_type = column.type.python_type
+    if python_type not in (int, float):
+        return raw
+    try:
+        value = python_type(raw)
+    except ValueError:
+        raise APIException(f'{column.key} must be {python_type.__name__}')
+    if not math.isfinite(value):
+        raise APIException(f'{column.key} must be a finite number')
+    return value
+
+def _value(column, op, raw):
+    if op == 'null':
+        if raw.lower() not in ('true', 'false', '1', '0'):
+            raise APIException(f'{column.key}[null] must be true or false')
+        return raw.lower() in ('true', '1')
+    if op == 'in':
+        return [_coerce(column, value) for value in raw.split(',')]
+    if op == 'contains' and column.type.python_type is not str:
+        raise APIException(f'{column.key}[contains] only applies to text fields')
+    return _coerce(column, raw)
+
+
+def filter_params(model):
+    # ?gender=female&mass_in_kg[gt]=80 -> [character.gender = :p1, character.mass_in_kg > :p2]
+    criteria = []
+    for key in request.args:
+        if key in RESERVED:
+            continue
+        match = PARAM.match(key)
+        if match is None or match.group(1) not in model.filter_fields:
+            raise APIException(f'Unknown filter {key}')
+        name, op = match.group(1), match.group(2) or 'eq'
+        if op not in OPERATORS:
+            raise APIException(f"Unknown operator {op}, expected one of: {', '.join(OPERATORS)}")
+        column = model.__table__.c[name]
+        for raw in request.args.getlist(key):
+            criteria.append(OPERATORS[op](column, _value(column, op, raw)))
+    return criteria
+
+def sort_param(model):
+    # ?sort=-population,name -> [(planet.population, True), (planet.name, False)]
+    sort = []
+    for name in request.args.get('sort', '').split(','):
+        name = name.strip()
+        if not name:
+            continue
+        descending = name.startswith('-')
+        name = name.lstrip('-+')
+        if name not in model.filter_fields:
+            raise APIException(f'Unknown sort field {name}')
+        sort.append((model.__table__.c[name], descending))
+    return sort
@@ -0,0 +1,117 @@
+"""
+Group commit: a request hands its write to a queue and blocks; one writer
+thread per process takes whatever queued up within a short window (or
+max_batch writes, whichever comes first), applies it all in one transaction
+and then wakes every request with its own result. Under contention one
+commit acknowledges many writes, instead of each request paying for its own.
+
+The acknowledgement is durable: submit() only returns once the transaction
+holding the write has committed, and raises if it failed. A submit() that
+times out may still commit later, so the writes going through here must be
+safe to retry.
+
+The batch sizes, the time writes wait in the queue and the flush times are
+exported at /metrics (metrics.py).
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from models import db
+from metrics import Histogram, LATENCY_BUCKETS, collectors, histogram_lines, counter_lines
+
+logger = logging.getLogger(__name__)
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class GroupCommitWriter:
+
+    def __init__(self, app, flush, name, window=0.005, max_batch=64, timeout=10):
+        # flush(payloads) applies and commits them, returning one result each
+        self.app = app
+        self.flush = flush
+        self.name = name
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.batch_sizes = Histogram(BATCH_BUCKETS)
+        self.flush_seconds = Histogram(LATENCY_BUCKETS)
+        self.wait_seconds = Histogram(LATENCY_BUCKETS)
+        self.failed_batches = 0
+        self._stats_lock = threading.Lock()
+        self._reset()
+        collectors.append(self.metrics_lines)
+
+    def _reset(self):
+        # also in a forked worker: the thread, and the queue, are per process
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def submit(self, payload):
+        if self._pid != os.getpid():
+            self._reset()
+        future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'{self.name}-group-commit', daemon=True)
+                self._thread.start()
+            self._pending.append((payload, future, time.perf_counter()))
+            self._condition.notify()
+        return future.result(self.timeout)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            # the window opens with the oldest queued write
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                with self.app.app_context():
+                    try:
+                        results = self.flush([payload for payload, _, _ in batch])
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                logger.exception('%s group commit of %d writes failed', self.name, len(batch))
+                with self._stats_lock:
+                    self.failed_batches += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self._stats_lock:
+                self.batch_sizes.observe(len(batch))
+                self.flush_seconds.observe(done - start)
+                for _, _, queued in batch:
+                    self.wait_seconds.observe(done - queued)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def metrics_lines(self):
+        labels = (('writer', self.name), ('pid', os.getpid()))
+        with self._stats_lock:
+            return (histogram_lines('group_commit_batch_size', 'Writes committed together.',
+                                    [(labels, self.batch_sizes)])
+                    + histogram_lines('group_commit_flush_seconds', 'Time to apply and commit a batch.',
+                                      [(labels, self.flush_seconds)])
+                    + histogram_lines('group_commit_wait_seconds', 'Time from queueing a write to its commit.',
+                                      [(labels, self.wait_seconds)])
+                    + counter_lines('group_commit_failed_batches_total', 'Batches whose transaction failed.',
+                                    [(labels, self.failed_batches)]))
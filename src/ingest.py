@@ -0,0 +1,146 @@
+"""
+Bulk loading for the catalog tables. Rows are validated one by one, then
+written with bulk insert/update mappings and committed in chunks, so loading
+tens of thousands of records doesn't build (or flush) an ORM object per row.
+Rows are matched on their unique `url` (or `name`) and existing ones are
+updated in place, which makes re-sending the same payload harmless.
+"""
+import json
+from itertools import islice
+from flask import request
+from sqlalchemy import BigInteger, or_
+from sqlalchemy.exc import IntegrityError
+from models import db
+from cache import invalidate_tables
+from utils import APIException, NDJSON
+
+
+def request_rows():
+    # A JSON array (or a single object) in the body, or one object per line
+    # when the body is sent as application/x-ndjson. NDJSON is read from the
+    # request stream as it arrives, and a bad line only fails that row.
+    if request.mimetype == NDJSON:
+        return _ndjson_rows(request.stream)
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise APIException('Expected a JSON array or an NDJSON body')
+    return iter(data)
+
+def _ndjson_rows(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f'invalid JSON: {e}')
+
+
+def _clean_row(model, row):
+    if isinstance(row, Exception):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('expected an object')
+    columns = model.__table__.columns
+    clean = {}
+    for key, value in row.items():
+        if key == 'id' or key not in columns:
+            raise ValueError(f'unknown field {key!r}')
+        column = columns[key]
+        if value is not None:
+            python_type = column.type.python_type
+            try:
+                if python_type is int:
+                    number = float(value)
+                    if not number.is_integer():
+                        raise ValueError
+                    value = int(number)
+                elif python_type is float:
+                    value = float(value)
+                elif not isinstance(value, str):
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise ValueError(f'{key!r} must be {python_type.__name__}')
+            if python_type is int and not -2**31 <= value < 2**31 and not isinstance(column.type, BigInteger):
+                raise ValueError(f'{key!r} is out of range')
+            length = getattr(column.type, 'length', None)
+            if length is not None and len(value) > length:
+                raise ValueError(f'{key!r} is longer than {length} characters')
+        clean[key] = value
+    if clean.get('url') is None and clean.get('name') is None:
+        raise ValueError('a url or a name is required')
+    return clean
+
+
+def _write_chunk(model, chunk, result):
+    # chunk is a list of (row number, clean mapping); the last row wins when
+    # the same url/name appears twice. result is only updated once the chunk
+    # is committed.
+    by_key = {}
+    for index, row in chunk:
+        by_key[row.get('url') or row.get('name')] = (index, row)
+    urls = [row['url'] for _, row in by_key.values() if row.get('url') is not None]
+    names = [row['name'] for _, row in by_key.values() if row.get('name') is not None]
+    existing_by_url = {}
+    existing_by_name = {}
+    for obj_id, url, name in db.session.query(model.id, model.url, model.name).filter(
+            or_(model.url.in_(urls), model.name.in_(names))):
+        # a NULL url or name matches nothing
+        if url is not None:
+            existing_by_url[url] = obj_id
+        if name is not None:
+            existing_by_name[name] = obj_id
+
+    inserts, updates, errors = [], [], []
+    for index, row in by_key.values():
+        url_match = existing_by_url.get(row['url']) if row.get('url') is not None else None
+        name_match = existing_by_name.get(row['name']) if row.get('name') is not None else None
+        if url_match is not None and name_match is not None and url_match != name_match:
+            errors.append({'row': index, 'error': 'url and name match different records'})
+        elif url_match is not None or name_match is not None:
+            updates.append(dict(row, id=url_match if url_match is not None else name_match))
+        else:
+            inserts.append(row)
+    db.session.bulk_insert_mappings(model, inserts)
+    db.session.bulk_update_mappings(model, updates)
+    db.session.commit()
+    result['inserted'] += len(inserts)
+    result['updated'] += len(updates)
+    result['errors'].extend(errors)
+
+
+def bulk_upsert(model, rows, chunk_size=1000):
+    result = {'inserted': 0, 'updated': 0, 'errors': []}
+    numbered = enumerate(rows)
+    try:
+        while True:
+            batch = list(islice(numbered, chunk_size))
+            if not batch:
+                break
+            chunk = []
+            for index, row in batch:
+                try:
+                    chunk.append((index, _clean_row(model, row)))
+                except ValueError as e:
+                    result['errors'].append({'row': index, 'error': str(e)})
+            if not chunk:
+                continue
+            try:
+                _write_chunk(model, chunk, result)
+            except IntegrityError:
+                # something the validation can't see (a dangling planet_id,
+                # a concurrent insert...): redo the chunk row by row to find it
+                db.session.rollback()
+                for index, row in chunk:
+                    try:
+                        _write_chunk(model, [(index, row)], result)
+                    except IntegrityError as e:
+                        db.session.rollback()
+                        result['errors'].append({'row': index, 'error': str(e.orig)})
+    finally:
+        # bulk mappings skip the ORM flush events the caches listen to
+        invalidate_tables([model.__tablename__])
+    return result
@@ -0,0 +1,161 @@
+"""
+Per-endpoint request metrics, exposed in the Prometheus text format at
+/metrics: latency and response size histograms, request counts by status,
+and the number of SQL queries and time spent in them.
+
+Latency is measured until the response is built; for streamed responses the
+rows written after that (and their queries) are not included. The numbers
+are per process: with several gunicorn workers each scrape sees the worker
+that served it, identified by the pid label.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.size = {}
+        self.requests = {}
+        self.queries = {}
+
+    def record(self, endpoint, method, status, elapsed, size, queries, db_time):
+        with self._lock:
+            key = (endpoint, method)
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.size[key] = Histogram(SIZE_BUCKETS)
+                self.queries[key] = [0, 0.0]
+            self.latency[key].observe(elapsed)
+            if size is not None:
+                self.size[key].observe(size)
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            self.queries[key][0] += queries
+            self.queries[key][1] += db_time
+
+    def render(self):
+        pid = ('pid', os.getpid())
+        lines = []
+        with self._lock:
+            lines += histogram_lines('http_request_duration_seconds', 'Time to build the response.',
+                                     [((('endpoint', e), ('method', m), pid), h)
+                                      for (e, m), h in sorted(self.latency.items())])
+            lines += histogram_lines('http_response_size_bytes', 'Size of the (non streamed) response bodies.',
+                                     [((('endpoint', e), ('method', m), pid), h)
+                                      for (e, m), h in sorted(self.size.items())])
+            lines += counter_lines('http_requests_total', 'Requests served, by status.',
+                                   [((('endpoint', e), ('method', m), pid, ('status', status)), n)
+                                    for (e, m, status), n in sorted(self.requests.items())])
+            lines += counter_lines('http_request_db_queries_total', 'SQL statements executed by the requests.',
+                                   [((('endpoint', e), ('method', m), pid), q[0])
+                                    for (e, m), q in sorted(self.queries.items())])
+            lines += counter_lines('http_request_db_seconds_total', 'Time spent executing those statements.',
+                                   [((('endpoint', e), ('method', m), pid), q[1])
+                                    for (e, m), q in sorted(self.queries.items())])
+        for collector in collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+def histogram_lines(name, help_text, series):
+    # series is [(label pairs, Histogram)]
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for pairs, h in series:
+        cumulative = 0
+        for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(pairs + (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(pairs)} {h.sum}')
+        lines.append(f'{name}_count{_labels(pairs)} {h.count}')
+    return lines
+
+def counter_lines(name, help_text, series):
+    # series is [(label pairs, value)]
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+    lines += [f'{name}{_labels(pairs)} {value}' for pairs, value in series]
+    return lines
+
+
+# other modules add a callable returning more lines (histogram_lines(), ...)
+collectors = []
+
+metrics = Metrics()
+
+
+# Hooks
+# ------------------------------------------------------------
+# [start, queries, db time] of the current request. A plain context variable
+# rather than flask.g: the cursor hooks run for every statement, and going
+# through g's proxy costs more than the counting itself.
+_request_state = ContextVar('request_metrics', default=None)
+
+def _start_request():
+    _request_state.set([time.perf_counter(), 0, 0.0])
+
+def _end_request(response):
+    state = _request_state.get()
+    _request_state.set(None)
+    if state is not None:
+        size = None if response.is_streamed else response.content_length
+        metrics.record(request.endpoint or 'none', request.method, response.status_code,
+                       time.perf_counter() - state[0], size, state[1], state[2])
+    return response
+
+def _teardown_request(exc):
+    # after_request is skipped when an exception escapes the handlers (with
+    # PROPAGATE_EXCEPTIONS, or from another after_request function); the
+    # request still counts, as the 500 the WSGI server answers
+    state = _request_state.get()
+    _request_state.set(None)
+    if state is not None:
+        metrics.record(request.endpoint or 'none', request.method, 500,
+                       time.perf_counter() - state[0], None, state[1], state[2])
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _request_state.get() is not None:
+        context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _request_state.get()
+    if state is not None:
+        start = getattr(context, '_metrics_start', None)
+        if start is not None:
+            state[1] += 1
+            state[2] += time.perf_counter() - start
+
+
+def setup_metrics(app):
+    if not app.config.get('METRICS', True):
+        return
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
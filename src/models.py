@@ -1,14 +1,21 @@
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import selectinload, load_only
+from cache import entity_cache, cached_serialize
+from replica import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+# a flask_sqlalchemy.SQLAlchemy whose session can send reads to a replica
+db = RoutingSQLAlchemy()
 
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(30), unique=True)
     password = db.Column(db.String(120))
-    favorites = db.relationship('Favorite', backref='user')
+    favorites = db.relationship('Favorite', backref='user', order_by='Favorite.id')
+    private_fields = ('password',)
+    relationship_fields = ('favorites',)
 
+    # not in the entity cache: it is per process, and a user must see their
+    # own favorite writes at once, whichever worker made them
     def serialize(self):
         return {
             "id": self.id,
@@ -26,12 +33,18 @@ class Planet(db.Model):
     orbital_period_in_days = db.Column(db.Float)
     gravity_in_g = db.Column(db.Float)
     population = db.Column(db.Integer)
-    climate = db.Column(db.String(240)) 
+    climate = db.Column(db.String(240), index=True)
     terrain = db.Column(db.String(240)) 
     surface_water_percent = db.Column(db.Float)
     characters = db.relationship('Character', backref='planet', lazy=True)
     favorite = db.relationship('Favorite', backref='planet')
+    # the columns ?field=value filters and ?sort= accept, see filters.py
+    filter_fields = ('name', 'url', 'diameter_in_km', 'rotation_period_in_days', 'orbital_period_in_days',
+                     'gravity_in_g', 'population', 'climate', 'terrain', 'surface_water_percent')
+    # what /search matches besides the name, see search.py
+    search_fields = ('climate', 'terrain')
 
+    @cached_serialize
     def serialize(self):
         return {
             "id": self.id,
@@ -57,7 +70,7 @@ class Vehicle(db.Model):
     name = db.Column(db.String(150), unique=True)
     url = db.Column(db.String(240), unique=True)
     model = db.Column(db.String(150))
-    vehicle_class = db.Column(db.String(150))
+    vehicle_class = db.Column(db.String(150), index=True)
     manufacturer = db.Column(db.String(150))
     cost_in_credits = db.Column(db.Float)
     length_in_m = db.Column(db.Float)
@@ -65,9 +78,17 @@ class Vehicle(db.Model):
     passengers = db.Column(db.Integer)
     max_atmosphering_speed_in_kmh = db.Column(db.Float)
     cargo_capacity_in_kg = db.Column(db.Float)
-    characters = db.relationship('Character_X_Vehicle')
+    characters = db.relationship('Character_X_Vehicle', order_by='Character_X_Vehicle.id')
     favorite = db.relationship('Favorite', backref='vehicle')
+    relationship_fields = ('characters',)
+    filter_fields = ('name', 'url', 'model', 'vehicle_class', 'manufacturer', 'cost_in_credits', 'length_in_m',
+                     'crew', 'passengers', 'max_atmosphering_speed_in_kmh', 'cargo_capacity_in_kg')
+    search_fields = ('model', 'vehicle_class', 'manufacturer')
 
+    def cache_dependencies(self):
+        return [('character', link.character_id) for link in self.characters]
+
+    @cached_serialize
     def serialize(self):
         return {
             "id": self.id,
@@ -100,11 +121,19 @@ class Character(db.Model):
     skin_color = db.Column(db.String(30))
     eye_color = db.Column(db.String(30))
     birthyear = db.Column(db.String(30))
-    gender = db.Column(db.String(30))
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'))
-    vehicles = db.relationship('Character_X_Vehicle')
+    gender = db.Column(db.String(30), index=True)
+    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'), index=True)
+    vehicles = db.relationship('Character_X_Vehicle', order_by='Character_X_Vehicle.id')
     favorite = db.relationship('Favorite', backref='character')
+    relationship_fields = ('vehicles',)
+    filter_fields = ('name', 'url', 'height_in_cm', 'mass_in_kg', 'hair_color', 'skin_color', 'eye_color',
+                     'birthyear', 'gender', 'planet_id')
+    search_fields = ('gender', 'hair_color', 'skin_color', 'eye_color')
+
+    def cache_dependencies(self):
+        return [('vehicle', link.vehicle_id) for link in self.vehicles]
 
+    @cached_serialize
     def serialize(self):
         return {
             "id": self.id,
@@ -126,6 +155,10 @@ class Character(db.Model):
 
 class Character_X_Vehicle(db.Model):
     __tablename__ = 'character_x_vehicle'
+    __table_args__ = (
+        db.Index('ix_character_x_vehicle_character_id_vehicle_id', 'character_id', 'vehicle_id'),
+        db.Index('ix_character_x_vehicle_vehicle_id', 'vehicle_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'))
     character = db.relationship('Character', backref='characters_vehicles')
@@ -146,22 +179,200 @@ class Character_X_Vehicle(db.Model):
 
 class Favorite(db.Model):
     __tablename__ = 'favorite'
+    # one favorite per (user, target); these also serve the user_id lookups
+    __table_args__ = (
+        db.Index('uq_favorite_user_id_character_id', 'user_id', 'character_id', unique=True),
+        db.Index('uq_favorite_user_id_planet_id', 'user_id', 'planet_id', unique=True),
+        db.Index('uq_favorite_user_id_vehicle_id', 'user_id', 'vehicle_id', unique=True),
+        db.Index('ix_favorite_character_id', 'character_id'),
+        db.Index('ix_favorite_planet_id', 'planet_id'),
+        db.Index('ix_favorite_vehicle_id', 'vehicle_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'))
     planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'))
     vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'))
+    relationship_fields = ('favorite',)
+
+    def target(self):
+        return self.character or self.planet or self.vehicle
 
     def serialize(self):
+        # a reference to the favorite object, see expand_favorites() for the
+        # full serialization
+        target = self.target()
         favorite = None
-        if self.character:
-            favorite = self.character.serialize()
-        elif self.planet:
-            favorite = self.planet.serialize()
-        elif self.vehicle:
-            favorite = self.vehicle.serialize()
+        if target is not None:
+            favorite = {
+                "type": target.__tablename__,
+                "id": target.id,
+                "name": target.name
+            }
         return {
             "id": self.id,
             "user_id": self.user_id,
             "favorite": favorite
-        }
\ No newline at end of file
+        }
+
+
+class ChangeLog(db.Model):
+    # One row per insert, update and delete of the catalog and the favorites,
+    # written by database triggers (see changes.py) so bulk and Core writes
+    # are logged too. (txid, id) is the version /changes pages on; deleted
+    # rows stay here as tombstones until the log is pruned.
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_txid_id', 'txid', 'id'),
+        # ids are never reused, even once the newest rows are pruned
+        {'sqlite_autoincrement': True},
+    )
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    # the writing transaction on Postgres, 0 on SQLite where writes are serialized
+    txid = db.Column(db.BigInteger, nullable=False, server_default='0')
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    # the owner, for favorites
+    user_id = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        return f'<ChangeLog ID: {self.id}, {self.op} {self.table_name} {self.row_id}>'
+
+
+# Loading plans
+# ------------------------------------------------------------
+# Every serialize() above walks relationships (vehicle names, favorites, ...).
+# Lazy loading them turns a list endpoint into one query per row, so each
+# route asks for one of these plans and the related rows come in a constant
+# number of selectin/joined queries instead.
+# They are functions because the backref attributes (Favorite.character, ...)
+# only exist once the mappers have been configured.
+
+def character_load_plan():
+    return [selectinload(Character.vehicles).joinedload(Character_X_Vehicle.vehicle)]
+
+def vehicle_load_plan():
+    return [selectinload(Vehicle.characters).joinedload(Character_X_Vehicle.character)]
+
+def planet_load_plan():
+    return []
+
+def favorite_load_plan(path=None):
+    # path is the option leading to the favorites (e.g. from User); without
+    # it the plan applies to a Favorite query directly. Only the targets are
+    # loaded (one query per type), for the names in the favorite references.
+    def load(attr):
+        return path.selectinload(attr) if path is not None else selectinload(attr)
+    return [load(Favorite.character), load(Favorite.planet), load(Favorite.vehicle)]
+
+def user_load_plan():
+    return favorite_load_plan(selectinload(User.favorites))
+
+
+# Sparse fieldsets
+# ------------------------------------------------------------
+# ?fields=id,name,url keeps only those keys in the output. When none of them
+# comes from a relationship, only the requested columns are selected
+# (load_only) and the relationships are never loaded. The ?sort= columns are
+# selected as well, the next page cursor is built from them.
+
+def field_names(model):
+    private = getattr(model, 'private_fields', ())
+    columns = [c.key for c in model.__table__.columns if c.key not in private]
+    return columns + list(getattr(model, 'relationship_fields', ()))
+
+def _columns_only(model, fields):
+    return fields is not None and not set(fields) & set(getattr(model, 'relationship_fields', ()))
+
+def fields_load_plan(model, fields, load_plan, sort=()):
+    if _columns_only(model, fields):
+        return [load_only(*fields, *(column.key for column, _ in sort))]
+    return load_plan
+
+def project(data, fields):
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields}
+
+def serialize_fields(obj, fields=None):
+    if _columns_only(type(obj), fields):
+        return {field: getattr(obj, field) for field in fields}
+    return project(obj.serialize(), fields)
+
+
+# Cached lookups
+# ------------------------------------------------------------
+# serialize() results are kept in the entity cache, so a hot id is answered
+# without a query at all; only the misses are loaded, in a single IN query.
+# Column-only fieldsets are projected from a cached entry when there is one,
+# and loaded with just those columns (and not cached) when there isn't.
+
+def _cached(model):
+    return hasattr(model.serialize, 'fill')
+
+def _serialize_missed(obj, fields):
+    # obj was looked up in the entity cache already, and missed
+    if _columns_only(type(obj), fields):
+        return {field: getattr(obj, field) for field in fields}
+    serialize = type(obj).serialize
+    return project(getattr(serialize, 'fill', serialize)(obj), fields)
+
+def serialize_entity(model, obj_id, load_plan=(), fields=None):
+    data = entity_cache.get((model.__tablename__, obj_id)) if _cached(model) else None
+    if data is not None:
+        return project(data, fields)
+    obj = model.query.options(*fields_load_plan(model, fields, load_plan)).filter_by(id=obj_id).first()
+    return _serialize_missed(obj, fields)
+
+def serialize_entities(model, ids, load_plan=(), fields=None):
+    found = {}
+    missing = []
+    for obj_id in ids:
+        data = entity_cache.get((model.__tablename__, obj_id)) if _cached(model) else None
+        if data is None:
+            missing.append(obj_id)
+        else:
+            found[obj_id] = project(data, fields)
+    if missing:
+        query = model.query.options(*fields_load_plan(model, fields, load_plan))
+        for obj in query.filter(model.id.in_(missing)):
+            found[obj.id] = _serialize_missed(obj, fields)
+    return [found[obj_id] for obj_id in ids if obj_id in found]
+
+# Expanded favorites
+# ------------------------------------------------------------
+# ?expand=favorites replaces each favorite reference with the serialized
+# object. The targets of all the favorites are fetched together: cache hits
+# first, then the misses in one query per type.
+
+def expand_favorites(favorites):
+    plans = {
+        'character': (Character, character_load_plan),
+        'planet': (Planet, planet_load_plan),
+        'vehicle': (Vehicle, vehicle_load_plan)
+    }
+    ids = {}
+    for f in favorites:
+        if f['favorite'] is not None:
+            ids.setdefault(f['favorite']['type'], []).append(f['favorite']['id'])
+    objects = {}
+    for kind, obj_ids in ids.items():
+        model, load_plan = plans[kind]
+        for data in serialize_entities(model, list(dict.fromkeys(obj_ids)), load_plan()):
+            objects[(kind, data['id'])] = data
+    expanded = []
+    for f in favorites:
+        ref = f['favorite']
+        expanded.append(dict(f, favorite=objects.get((ref['type'], ref['id'])) if ref else None))
+    return expanded
+
+def expand_users(users):
+    favorites = expand_favorites([f for user in users for f in user['favorites']])
+    expanded = []
+    for user in users:
+        expanded.append(dict(user, favorites=favorites[:len(user['favorites'])]))
+        favorites = favorites[len(user['favorites']):]
+    return expanded
+
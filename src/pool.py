@@ -0,0 +1,88 @@
+"""
+Connection pool settings and telemetry. The pool is sized per process: each
+gunicorn worker has its own, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+
+GET /pool/stats reports what the pool of this process has been doing
+(checked out and overflow connections, checkout waits, timeouts) to size it
+from data.
+"""
+import logging
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedQueuePool(QueuePool):
+    # QueuePool counting how long checkouts wait for a free connection
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak_checked_out = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            logger.warning('connection pool exhausted after %.1fs: %s', time.perf_counter() - start, self.status())
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+        return conn
+
+    def stats(self):
+        return {
+            "pool": type(self).__name__,
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "timeout": self._timeout,
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": max(self.overflow(), 0),
+            "peak_checked_out": self.peak_checked_out,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3)
+        }
+
+
+def engine_options(config):
+    # SQLALCHEMY_ENGINE_OPTIONS for the configured database. SQLite keeps the
+    # pool SQLAlchemy picks for it (connections can't be shared across threads).
+    url = config['SQLALCHEMY_DATABASE_URI']
+    if url.startswith('sqlite'):
+        return {}
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        "pool_pre_ping": config['DB_POOL_PRE_PING']
+    }
+    if url.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {"options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"}
+    return options
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {"pool": type(pool).__name__, "status": pool.status()}
@@ -0,0 +1,127 @@
+"""
+Query budgets and an N+1 detector, for development and tests. Off unless
+QUERY_DEBUG is set:
+  - log: every request counts its SQL statements and logs a warning when it
+    goes over its route's budget, when the same statement runs QUERY_REPEATS
+    times or more with different parameters, and with the stack of each lazy
+    load (relationship or deferred column) it triggers
+  - raise: the same, and going over the budget raises QueryBudgetExceeded,
+    which fails the request and so the test that sent it
+
+Routes declare their budget under the route decorator:
+
+    @app.route('/planets', methods=['GET'])
+    @query_budget(2)
+    def get_planets():
+"""
+import logging
+import sysconfig
+import traceback
+from collections import Counter
+from contextvars import ContextVar
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import strategies
+
+logger = logging.getLogger(__name__)
+
+# frames from these folders are left out of the logged stacks
+LIBRARIES = tuple({sysconfig.get_paths()[name] for name in ('stdlib', 'purelib', 'platlib')})
+
+# statements of the current request, with the lazy loads that ran them
+_request_queries = ContextVar('request_queries', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_queries):
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+class RequestQueries:
+    def __init__(self):
+        self.statements = Counter()
+        self.lazy_loads = {}
+
+    @property
+    def count(self):
+        return sum(self.statements.values())
+
+    def repeated(self, threshold):
+        return [(statement, n) for statement, n in self.statements.most_common() if n >= threshold]
+
+
+def _app_stack():
+    # the application's frames, without the libraries and the detector itself
+    return [frame for frame in traceback.extract_stack()
+            if not frame.filename.startswith(LIBRARIES) and frame.filename != __file__]
+
+
+def _patch_lazy_loader(loader_class, method):
+    load = getattr(loader_class, method)
+    if getattr(load, 'query_budget', False):
+        return
+
+    def lazy_load(self, *args):
+        queries = _request_queries.get()
+        if queries is not None:
+            stack = _app_stack()
+            key = (str(self.parent_property), (stack[-1].filename, stack[-1].lineno) if stack else None)
+            if key not in queries.lazy_loads:
+                queries.lazy_loads[key] = stack
+                logger.warning('lazy load of %s during %s %s\n%s', key[0], request.method, request.path,
+                               ''.join(traceback.format_list(stack)))
+        return load(self, *args)
+
+    lazy_load.query_budget = True
+    setattr(loader_class, method, lazy_load)
+
+
+# Hooks
+# ------------------------------------------------------------
+
+def _start_request():
+    _request_queries.set(RequestQueries())
+
+def _end_request(response):
+    queries = _request_queries.get()
+    _request_queries.set(None)
+    if queries is None:
+        return response
+    config = current_app.config
+    response.headers['X-Query-Count'] = str(queries.count)
+    for statement, n in queries.repeated(config.get('QUERY_REPEATS', 3)):
+        logger.warning('%s %s ran the same statement %d times (N+1?): %s',
+                       request.method, request.path, n, ' '.join(statement.split()))
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    if budget is not None and queries.count > budget:
+        message = f'{request.method} {request.path} ran {queries.count} queries, its budget is {budget}'
+        if config.get('QUERY_DEBUG') == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.statements[statement] += 1
+
+
+def setup_query_budget(app):
+    if app.config.get('QUERY_DEBUG') not in ('log', 'raise'):
+        return
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+        event.listen(Engine, 'before_cursor_execute', _count_statement)
+        # the loaders' methods that are looked up on each load (the mappers
+        # may already hold bound _load_for_state methods)
+        _patch_lazy_loader(strategies.LazyLoader, '_emit_lazyload')
+        _patch_lazy_loader(strategies.DeferredColumnLoader, '_load_for_state')
@@ -0,0 +1,91 @@
+"""
+Read-replica routing. With REPLICA_DATABASE_URL set (the "replica" entry of
+SQLALCHEMY_BINDS), the queries of GET/HEAD requests go to the replica and
+everything else goes to the primary: flushes, other methods (the favorite
+writes), the admin, and CLI commands.
+
+The replica lags behind the primary, so after a commit reads go back to the
+primary for READ_YOUR_WRITES seconds:
+  - for the client that wrote, through a cookie set on the write's response
+  - in this process, for the tables the commit touched, so that the caches
+    it invalidated are refilled from fresh rows
+"""
+import math
+import time
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.util import find_tables
+from cache import commit_listeners, bulk_write_listeners
+
+REPLICA = 'replica'
+COOKIE = 'read_primary_until'
+
+# seconds reads stay on the primary after a write, set by setup_replica()
+window = 5
+# table -> time until which it is read from the primary
+_recent_tables = {}
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not _reads_from_replica(self.app, mapper, clause):
+            return super().get_bind(mapper, clause)
+        return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _tables(mapper, clause):
+    if mapper is not None:
+        return [mapper.persist_selectable.name]
+    if clause is not None:
+        return [table.name for table in find_tables(clause, include_joins=True)]
+    return []
+
+def _reads_from_replica(app, mapper, clause):
+    if REPLICA not in (app.config['SQLALCHEMY_BINDS'] or {}) or not has_request_context():
+        return False
+    if request.method not in ('GET', 'HEAD') or request.path.startswith('/admin'):
+        return False
+    now = time.time()
+    try:
+        if float(request.cookies.get(COOKIE, 0)) > now:
+            return False
+    except ValueError:
+        pass
+    return not any(_recent_tables.get(table, 0) > now for table in _tables(mapper, clause))
+
+
+def _mark_written(tables):
+    until = time.time() + window
+    for table in tables:
+        _recent_tables[table] = until
+    if has_request_context():
+        g.read_primary_until = until
+
+def _commit_tables(tables, rows):
+    _mark_written(tables)
+
+def _set_cookie(response):
+    until = g.pop('read_primary_until', None)
+    if until is not None:
+        response.set_cookie(COOKIE, f'{until:.3f}', max_age=math.ceil(window), httponly=True, samesite='Lax')
+    return response
+
+
+def setup_replica(app):
+    global window
+    window = app.config.get('READ_YOUR_WRITES', 5)
+    if REPLICA not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+    app.after_request(_set_cookie)
+    if _commit_tables not in commit_listeners:
+        commit_listeners.append(_commit_tables)
+        # bulk writes skip the session events
+        bulk_write_listeners.append(_mark_written)
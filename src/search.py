@@ -0,0 +1,220 @@
+"""
+Ranked full-text search across the catalog, for /search?q=. Matches the name
+of characters, planets and vehicles (weighted highest) and their
+`search_fields`, every term of the query must match.
+
+Depending on the database, the work is done by:
+  - postgres: tsvector expressions, backed by GIN indexes
+  - fts: the SQLite FTS5 table search_index, kept up to date by triggers
+  - memory: an inverted index in this process, when neither is available
+
+The indexes are created by their migration; SEARCH_BACKEND=memory (or fts,
+postgres) overrides the detection.
+"""
+import heapq
+import math
+import re
+import threading
+import time
+from flask import current_app, request
+from sqlalchemy import text
+from models import db, Character, Planet, Vehicle
+from cache import commit_listeners, bulk_write_listeners
+from utils import APIException
+
+# table -> model, and the code of its rows in the FTS5 rowid (id * 4 + code)
+MODELS = {'planet': Planet, 'vehicle': Vehicle, 'character': Character}
+CODES = {'planet': 1, 'vehicle': 2, 'character': 3}
+
+TOKEN = re.compile(r'[^\W_]+')
+
+def tokenize(value):
+    return TOKEN.findall(value.lower()) if value else []
+
+
+def search_params():
+    # ?q=arid desert&type=planet,vehicle
+    terms = tokenize(request.args.get('q', ''))
+    if not terms:
+        raise APIException('q is required')
+    kinds = [kind for kind in request.args.get('type', '').split(',') if kind]
+    unknown = [kind for kind in kinds if kind not in MODELS]
+    if unknown:
+        raise APIException(f"Unknown types: {', '.join(unknown)}")
+    return terms, kinds or list(MODELS)
+
+
+_detected = {}
+
+def backend():
+    configured = current_app.config['SEARCH_BACKEND']
+    if configured != 'auto':
+        return configured
+    engine = db.engine
+    if engine.url not in _detected:
+        if engine.dialect.name == 'postgresql':
+            _detected[engine.url] = 'postgres'
+        elif engine.dialect.name == 'sqlite' and engine.has_table('search_index'):
+            _detected[engine.url] = 'fts'
+        else:
+            _detected[engine.url] = 'memory'
+    return _detected[engine.url]
+
+def find(terms, kinds, limit):
+    # [{"type": "planet", "id": 1, "name": "Tatooine"}, ...], best match first
+    engine = backend()
+    if engine == 'postgres':
+        return _find_postgres(terms, kinds, limit)
+    if engine == 'fts':
+        return _find_fts(terms, kinds, limit)
+    return memory_index.find(terms, kinds, limit)
+
+
+# SQLite FTS5
+# ------------------------------------------------------------
+
+def _find_fts(terms, kinds, limit):
+    # quoted, so the terms are never read as FTS5 operators
+    match = ' '.join(f'"{term}"' for term in terms)
+    codes = ', '.join(str(CODES[kind]) for kind in kinds)
+    rows = db.session.execute(text(
+        f"SELECT rowid, name FROM search_index WHERE search_index MATCH :match AND rowid % 4 IN ({codes}) "
+        f"ORDER BY bm25(search_index, 10.0, 1.0), rowid LIMIT :limit"), {'match': match, 'limit': limit})
+    kind_of = {code: kind for kind, code in CODES.items()}
+    return [{"type": kind_of[rowid % 4], "id": rowid // 4, "name": name} for rowid, name in rows]
+
+
+# Postgres
+# ------------------------------------------------------------
+# The document expression must stay identical to the one the GIN indexes
+# were created on, or the planner won't use them.
+
+def _pg_document(model):
+    body = " || ' ' || ".join(f"coalesce({column}, '')" for column in model.search_fields)
+    return (f"setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+            f"setweight(to_tsvector('simple', {body}), 'B')")
+
+def _find_postgres(terms, kinds, limit):
+    selects = [
+        f"SELECT '{kind}' AS type, id, name, ts_rank({_pg_document(MODELS[kind])}, query) AS rank "
+        f"FROM \"{kind}\", plainto_tsquery('simple', :q) query WHERE {_pg_document(MODELS[kind])} @@ query"
+        for kind in kinds
+    ]
+    rows = db.session.execute(text(
+        ' UNION ALL '.join(selects) + ' ORDER BY rank DESC, type, id LIMIT :limit'),
+        {'q': ' '.join(terms), 'limit': limit})
+    return [{"type": kind, "id": obj_id, "name": name} for kind, obj_id, name, _ in rows]
+
+
+# In-process index
+# ------------------------------------------------------------
+# token -> {(table, id): weight}. The tables are loaded by the first search;
+# after that, the rows a commit touches are marked dirty and read again by the
+# next search, and a bulk write reloads its table. The TTL bounds how long
+# writes made by other worker processes stay invisible.
+
+class InvertedIndex:
+    NAME_WEIGHT = 10
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._postings = {}
+        self._documents = {}
+        self._loaded = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def find(self, terms, kinds, limit):
+        with self._lock:
+            self._refresh()
+            postings = [self._postings.get(term, {}) for term in dict.fromkeys(terms)]
+            postings.sort(key=len)
+            kinds = set(kinds)
+            candidates = [key for key in postings[0] if key[0] in kinds]
+            for other in postings[1:]:
+                candidates = [key for key in candidates if key in other]
+            total = len(self._documents)
+            idf = [math.log(1 + total / len(p)) for p in postings] if candidates else []
+            scores = {key: sum(p[key] * weight for p, weight in zip(postings, idf)) for key in candidates}
+            best = heapq.nsmallest(limit, candidates, key=lambda key: (-scores[key], key))
+            return [{"type": key[0], "id": key[1], "name": self._documents[key][0]} for key in best]
+
+    def mark_dirty(self, keys):
+        with self._lock:
+            self._dirty.update(key for key in keys if key[0] in self._loaded)
+
+    def invalidate_tables(self, tables):
+        with self._lock:
+            for table in tables:
+                self._loaded.pop(table, None)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._loaded.clear()
+            self._dirty.clear()
+
+    def _refresh(self):
+        now = time.monotonic()
+        for kind in MODELS:
+            if kind not in self._loaded or self._loaded[kind] + self.ttl < now:
+                self._load(kind, now)
+        dirty = {}
+        for kind, obj_id in self._dirty:
+            dirty.setdefault(kind, []).append(obj_id)
+        self._dirty.clear()
+        for kind, ids in dirty.items():
+            # deleted rows don't come back from the query and stay removed
+            for obj_id in ids:
+                self._remove((kind, obj_id))
+            for i in range(0, len(ids), 500):
+                for row in self._rows(MODELS[kind]).filter(MODELS[kind].id.in_(ids[i:i + 500])):
+                    self._add(kind, row)
+
+    def _rows(self, model):
+        return db.session.query(model.id, model.name, *(getattr(model, f) for f in model.search_fields))
+
+    def _load(self, kind, now):
+        for key in [key for key in self._documents if key[0] == kind]:
+            self._remove(key)
+        for row in self._rows(MODELS[kind]).yield_per(1000):
+            self._add(kind, row)
+        self._loaded[kind] = now
+        self._dirty = {key for key in self._dirty if key[0] != kind}
+
+    def _add(self, kind, row):
+        key = (kind, row[0])
+        weights = {}
+        for token in tokenize(row[1]):
+            weights[token] = weights.get(token, 0) + self.NAME_WEIGHT
+        for value in row[2:]:
+            for token in tokenize(value):
+                weights[token] = weights.get(token, 0) + 1
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[key] = weight
+        self._documents[key] = (row[1], tuple(weights))
+
+    def _remove(self, key):
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        for token in document[1]:
+            postings = self._postings[token]
+            del postings[key]
+            if not postings:
+                del self._postings[token]
+
+
+memory_index = InvertedIndex()
+
+
+def _apply_changes(tables, rows):
+    memory_index.mark_dirty(rows)
+
+
+def setup_search(app):
+    memory_index.ttl = app.config.get('SEARCH_INDEX_TTL', 300)
+    if _apply_changes not in commit_listeners:
+        commit_listeners.append(_apply_changes)
+        bulk_write_listeners.append(memory_index.invalidate_tables)
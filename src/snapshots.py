@@ -0,0 +1,323 @@
+"""
+Catalog snapshots: the whole of /planets, /vehicles and /characters rendered
+to static files, so a cold client bootstraps with one download per type
+instead of paging through the list routes.
+
+    GET /snapshots
+    {"version": "0-4812", "cursor": "WzAsNDgyMF0", "built_at": "...",
+     "files": {"characters.json": {"url": "/snapshots/0-4812/characters.json",
+                                   "rows": 1000, "size": 371264, "etag": "...",
+                                   "encodings": {"gzip": 48133, "br": 39020}}, ...}}
+
+    GET /snapshots/characters.ndjson            the current version
+    GET /snapshots/0-4812/characters.ndjson     that version, cached forever
+
+Each type comes as a JSON array and as NDJSON, byte for byte what the list
+routes return (fast_serializer.py), precompressed with gzip and, when the
+brotli package is installed, brotli. The files are sent as they are on disk:
+no serialization or compression per request, and the WSGI server can
+sendfile() them. Every file and encoding has its own ETag.
+
+A version is the last catalog change in change_log (changes.py); after
+loading a snapshot, a client follows /changes?since=<its cursor>. A commit
+that touches the catalog rebuilds the snapshot in a background thread; the
+writes of other processes are noticed by the snapshot routes, at most every
+SNAPSHOT_CHECK_INTERVAL seconds. Meanwhile the previous version is served.
+`flask build-snapshots` builds it up front (e.g. on deploy).
+"""
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from flask import request, send_file
+from sqlalchemy import func
+from models import db, ChangeLog, Character, Planet, Vehicle, field_names
+from cache import commit_listeners, bulk_write_listeners
+from changes import head
+from utils import APIException, encode_cursor, NDJSON
+import fast_serializer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# file name -> model
+CATALOG = {'planets': Planet, 'vehicles': Vehicle, 'characters': Character}
+# the tables whose writes change a snapshot
+TABLES = {'planet', 'vehicle', 'character', 'character_x_vehicle'}
+FORMATS = {'json': 'application/json', 'ndjson': NDJSON}
+# Content-Encoding -> file suffix, preferred first
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+VERSION = re.compile(r'\d+-\d+')
+
+
+def catalog_version():
+    # "txid-id" of the last catalog change; on Postgres only of the
+    # transactions older than every one still running, a change committing
+    # late is a newer version
+    query = db.session.query(ChangeLog.txid, ChangeLog.id).filter(ChangeLog.table_name.in_(['planet', 'vehicle', 'character']))
+    if db.engine.dialect.name == 'postgresql':
+        query = query.filter(ChangeLog.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    last = query.order_by(ChangeLog.txid.desc(), ChangeLog.id.desc()).first()
+    return f'{last.txid}-{last.id}' if last is not None else '0-0'
+
+
+class _Artifact:
+    # one file and its compressed copies, written as the text comes
+
+    def __init__(self, path, gzip_level, brotli_quality):
+        self.path = path
+        self.plain = open(path, 'wb')
+        self.gzip = gzip.GzipFile(path + ENCODINGS['gzip'], 'wb', gzip_level, mtime=0)
+        self.brotli = None
+        if brotli is not None:
+            self.brotli = brotli.Compressor(quality=brotli_quality)
+            self.brotli_file = open(path + ENCODINGS['br'], 'wb')
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.rows = 0
+
+    def write(self, text, rows=0):
+        data = text.encode()
+        self.plain.write(data)
+        self.gzip.write(data)
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.process(data))
+        self.hash.update(data)
+        self.rows += rows
+
+    def close(self):
+        self.plain.close()
+        self.gzip.close()
+        encodings = {'gzip': os.path.getsize(self.path + ENCODINGS['gzip'])}
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.finish())
+            self.brotli_file.close()
+            encodings['br'] = os.path.getsize(self.path + ENCODINGS['br'])
+        return {'rows': self.rows, 'size': os.path.getsize(self.path), 'etag': self.hash.hexdigest(),
+                'encodings': encodings}
+
+
+class SnapshotStore:
+
+    def __init__(self):
+        self.folder = os.path.join(tempfile.gettempdir(), 'snapshots')
+        self.check_interval = 10
+        self.keep = 3
+        self.gzip_level = 9
+        self.brotli_quality = 9
+        self.app = None
+        self._manifest = None
+        self._manifest_mtime = None
+        self._checked = 0
+        self._reset()
+
+    def _reset(self):
+        # also in a forked worker: the builder thread is per process
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._again = False
+
+    # Reading
+    # ------------------------------------------------------------
+
+    def path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def current(self):
+        # the manifest of the current version, None before the first build;
+        # read again only when another process published a new one
+        try:
+            mtime = os.stat(self.path('current.json')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime != self._manifest_mtime:
+            with open(self.path('current.json')) as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def manifest(self, version):
+        if not VERSION.fullmatch(version):
+            return None
+        if version == (self.current() or {}).get('version'):
+            return self._manifest
+        try:
+            with open(self.path(version, 'manifest.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def check(self):
+        # notices the catalog writes of other processes
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        manifest = self.current()
+        if manifest is None or manifest['version'] != catalog_version():
+            self.rebuild()
+
+    # Building
+    # ------------------------------------------------------------
+
+    def rebuild(self):
+        # in the background; a rebuild asked for during one runs right after it
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._thread is not None:
+                self._again = True
+                return
+            self._thread = threading.Thread(target=self._run, name='snapshot-builder', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    try:
+                        self.build()
+                    finally:
+                        db.session.remove()
+            except Exception:
+                logger.exception('snapshot build failed')
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+                self._again = False
+
+    def build(self):
+        # the manifest of the catalog as it is now, rendered unless it already
+        # was; one process at a time renders
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.path('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = catalog_version()
+            manifest = self.manifest(version)
+            if manifest is None:
+                manifest = self._render(version)
+            self._publish(manifest)
+            self._prune()
+            return manifest
+
+    def _render(self, version):
+        # the /changes cursor is taken first: what the files miss comes after it
+        cursor = encode_cursor(head())
+        start = time.perf_counter()
+        folder = tempfile.mkdtemp(prefix='.build-', dir=self.folder)
+        files = {}
+        for name, model in CATALOG.items():
+            array = _Artifact(os.path.join(folder, f'{name}.json'), self.gzip_level, self.brotli_quality)
+            lines = _Artifact(os.path.join(folder, f'{name}.ndjson'), self.gzip_level, self.brotli_quality)
+            array.write('[')
+            first = True
+            for encoded in fast_serializer.encoded_chunks(model, field_names(model)):
+                array.write(('' if first else ',') + ','.join(encoded), len(encoded))
+                lines.write('\n'.join(encoded) + '\n', len(encoded))
+                first = False
+            array.write(']\n')
+            files[f'{name}.json'] = array.close()
+            files[f'{name}.ndjson'] = lines.close()
+        db.session.commit()
+        manifest = {'version': version, 'cursor': cursor, 'built_at': datetime.utcnow().isoformat() + 'Z',
+                    'files': files}
+        with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        os.chmod(folder, 0o755)
+        os.rename(folder, self.path(version))
+        logger.info('snapshot %s built in %.1fs', version, time.perf_counter() - start)
+        return manifest
+
+    def _publish(self, manifest):
+        if (self.current() or {}).get('version') == manifest['version']:
+            return
+        temporary = self.path(f'.current-{os.getpid()}.json')
+        with open(temporary, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temporary, self.path('current.json'))
+
+    def _prune(self):
+        # the `keep` newest versions stay, for the downloads still going on;
+        # and what a crashed build left behind
+        versions = []
+        for entry in os.scandir(self.folder):
+            if entry.is_dir() and entry.name.startswith('.build-'):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.is_dir():
+                versions.append((entry.stat().st_mtime, entry.path))
+        for _, path in sorted(versions, reverse=True)[self.keep:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def catalog_written(self, tables, rows=None):
+        if TABLES & set(tables):
+            self.rebuild()
+
+
+snapshots = SnapshotStore()
+
+
+# Serving
+# ------------------------------------------------------------
+
+def snapshot_manifest():
+    snapshots.check()
+    manifest = snapshots.current()
+    if manifest is None:
+        raise APIException('The first snapshot is being built, try again shortly', status_code=503)
+    files = {name: dict(info, url=f"/snapshots/{manifest['version']}/{name}")
+             for name, info in manifest['files'].items()}
+    return dict(manifest, files=files)
+
+def snapshot_response(name, version=None):
+    if version is None:
+        snapshots.check()
+        manifest = snapshots.current()
+        if manifest is None:
+            raise APIException('The first snapshot is being built, try again shortly', status_code=503)
+    else:
+        manifest = snapshots.manifest(version)
+        if manifest is None:
+            raise APIException('No such snapshot version, see /snapshots', status_code=404)
+    info = manifest['files'].get(name)
+    if info is None:
+        raise APIException(f'No such snapshot file {name}', status_code=404)
+    encoding = next((encoding for encoding in ENCODINGS
+                     if encoding in info['encodings'] and request.accept_encodings[encoding]), None)
+    path = snapshots.path(manifest['version'], name + (ENCODINGS[encoding] if encoding else ''))
+    etag = info['etag'] + (f'-{encoding}' if encoding else '')
+    # a versioned URL never changes; the current one is revalidated with its ETag
+    response = send_file(path, mimetype=FORMATS[name.rsplit('.', 1)[1]], etag=etag, conditional=True,
+                         max_age=31536000 if version is not None else None)
+    if version is not None:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def setup_snapshots(app):
+    snapshots.app = app
+    snapshots.folder = app.config.get('SNAPSHOT_DIR', snapshots.folder)
+    snapshots.check_interval = app.config.get('SNAPSHOT_CHECK_INTERVAL', 10)
+    snapshots.keep = app.config.get('SNAPSHOT_KEEP', 3)
+    snapshots.brotli_quality = app.config.get('SNAPSHOT_BROTLI_QUALITY', 9)
+    if snapshots.catalog_written not in commit_listeners:
+        commit_listeners.append(snapshots.catalog_written)
+        bulk_write_listeners.append(snapshots.catalog_written)
@@ -1,4 +1,9 @@
-from flask import jsonify, url_for
+import base64
+import hmac
+import json
+from functools import partial, wraps
+from flask import jsonify, url_for, request, current_app, Response, stream_with_context
+from sqlalchemy import and_, or_
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +20,167 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+# Keyset pagination
+# ------------------------------------------------------------
+# Collections are paged on the primary key: the cursor is an opaque token
+# holding the last key of the previous page, so every page is an index range
+# scan (`id > :last ORDER BY id LIMIT n`) no matter how deep the client goes.
+# With ?sort= the cursor holds the sort values of that row too, followed by
+# its key, which breaks ties. NULLs sort last in both directions.
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise APIException('Invalid cursor')
+    if not isinstance(values, list) or not values:
+        raise APIException('Invalid cursor')
+    return values
+
+def page_params(sort=()):
+    default = current_app.config['PAGE_SIZE']
+    maximum = current_app.config['MAX_PAGE_SIZE']
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        raise APIException('limit must be an integer')
+    if limit < 1:
+        raise APIException('limit must be positive')
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return min(limit, maximum), None
+    values = decode_cursor(cursor)
+    # a cursor from a differently sorted listing
+    if len(values) != len(sort) + 1:
+        raise APIException('Invalid cursor')
+    return min(limit, maximum), values
+
+def order_clauses(column, sort=()):
+    # sort is a list of (column, descending) pairs, column the unique key
+    clauses = [c.desc().nullslast() if descending else c.asc().nullslast() for c, descending in sort]
+    return clauses + [column]
+
+def after_cursor(column, sort, cursor):
+    # the rows that come after the cursor row in order_clauses() order:
+    # a > :a OR a IS NULL OR (a = :a AND (b > :b OR ... (id > :id)))
+    condition = column > cursor[-1]
+    for (c, descending), value in reversed(list(zip(sort, cursor))):
+        if value is None:
+            condition = and_(c.is_(None), condition)
+        else:
+            beyond = c < value if descending else c > value
+            condition = or_(beyond, c.is_(None), and_(c == value, condition))
+    return condition
+
+def paginate(query, column, limit, cursor, sort=()):
+    if cursor is not None:
+        query = query.filter(after_cursor(column, sort, cursor))
+    # one extra row tells us whether there is a next page
+    rows = query.order_by(*order_clauses(column, sort)).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c, _ in sort] + [getattr(last, column.key)])
+    return rows, next_cursor
+
+def paginated_response(items, next_cursor):
+    return add_next_link(jsonify(items), next_cursor)
+
+def add_next_link(response, next_cursor):
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        url = url_for(request.endpoint, _external=True, **(request.view_args or {}), **args)
+        response.headers['Link'] = f'<{url}>; rel="next"'
+    return response
+
+def fields_param(allowed):
+    # ?fields=id,name,url -> ['id', 'name', 'url'], None when not given
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = list(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise APIException(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def wants_expanded(relation):
+    # ?expand=favorites or ?depth=1 (or more) embeds the related objects
+    # instead of references to them
+    if relation in request.args.get('expand', '').split(','):
+        return True
+    try:
+        return int(request.args.get('depth', 0)) > 0
+    except ValueError:
+        raise APIException('depth must be an integer')
+
+# Streaming
+# ------------------------------------------------------------
+# Full-table exports (`?stream=true` or `Accept: application/x-ndjson`) skip
+# pagination and are written out as they are read: rows come from the
+# database `chunk_size` at a time (yield_per) and each chunk is flushed to the
+# client before the next one is fetched, so memory stays flat.
+
+NDJSON = 'application/x-ndjson'
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+def wants_stream():
+    return wants_ndjson() or request.args.get('stream', '').lower() in ('1', 'true')
+
+def streamed_response(query, serialize=lambda obj: obj.serialize()):
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    ndjson = wants_ndjson()
+    dumps = partial(current_app.json.dumps, separators=(',', ':'))
+
+    def generate():
+        chunk = []
+        first = True
+        if not ndjson:
+            yield '['
+        for obj in query.yield_per(chunk_size):
+            if ndjson:
+                chunk.append(dumps(serialize(obj)) + '\n')
+            else:
+                chunk.append(dumps(serialize(obj)) if first else ',' + dumps(serialize(obj)))
+                first = False
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+        if not ndjson:
+            yield ']\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON if ndjson else 'application/json')
+
+# Operations routes
+# ------------------------------------------------------------
+# The stats and metrics routes show the inner workings of the process. With
+# OPS_TOKEN set they need it as a bearer token (Authorization: Bearer ...);
+# without one they are only served outside production (API_ONLY unset).
+
+def ops_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get('OPS_TOKEN')
+        if token:
+            expected = f'Bearer {token}'.encode()
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+                raise APIException('Missing or wrong ops token', status_code=401)
+        elif current_app.config.get('API_ONLY'):
+            raise APIException('Not found', status_code=404)
+        return view(*args, **kwargs)
+    return wrapper
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()